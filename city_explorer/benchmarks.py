@@ -0,0 +1,674 @@
+"""Benchmarks for the performance critical parts of City Explorer.
+
+Run a benchmark by name, e.g. `python city_explorer/benchmarks.py connection_reuse`.
+Benchmarks which talk to the flask application expect it to be running, see
+`tabpy_loader.py`.
+"""
+import gc
+import logging
+import os
+import sys
+import time
+from typing import TYPE_CHECKING, Callable, Dict
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+FLASK_URL = "http://localhost:5001"
+
+# An example city (Atlanta, GA)
+CITY_ID = 1840013660
+
+
+def _time_calls(func: Callable, n_calls: int) -> float:
+    """Return the average number of seconds a call to `func` takes."""
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        func()
+    return (time.perf_counter() - start) / n_calls
+
+
+def _rss_bytes() -> int:
+    """Return the resident set size of this process in bytes. Linux only, else 0."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def benchmark_connection_reuse(
+    n_requests: int = 200, city_id: int = CITY_ID
+) -> Dict[str, float]:
+    """Compare a new connection per request with a pooled keep-alive session.
+
+    The difference between the two is the connection setup overhead paid by every
+    TabPy call that does not reuse its connection. `city_id` must be a city in the
+    served dataset, as failed requests raise rather than being timed.
+    """
+    import requests
+
+    url = f"{FLASK_URL}/rank_similar_cities/"
+    data = dict(cities=[city_id], city_id=city_id, occupation_title="All Occupations")
+    session = requests.Session()
+
+    def _new_connection():
+        requests.post(url, data=data).raise_for_status()
+
+    def _pooled_session():
+        session.post(url, data=data).raise_for_status()
+
+    results = dict(
+        new_connection=_time_calls(_new_connection, n_requests),
+        pooled_session=_time_calls(_pooled_session, n_requests),
+    )
+    results["connection_overhead"] = (
+        results["new_connection"] - results["pooled_session"]
+    )
+
+    for name, seconds in results.items():
+        logger.info("%s: %.3f ms per request", name, seconds * 1000)
+
+    return results
+
+
+def benchmark_response_format(n_requests: int = 50) -> Dict[str, float]:
+    """Compare requesting and parsing every similarity score as JSON and as Arrow."""
+    import pandas as pd
+    import pyarrow as pa
+    import requests
+
+    url = f"{FLASK_URL}/predict_similar_cities/"
+    params = dict(city_id=CITY_ID, occupation_title="All Occupations")
+    session = requests.Session()
+
+    def _json():
+        response = session.get(url, params=params)
+        return pd.Series(response.json())
+
+    def _arrow():
+        response = session.get(
+            url,
+            params=params,
+            headers={"Accept": "application/vnd.apache.arrow.stream"},
+        )
+        return pa.ipc.open_stream(response.content).read_all().to_pandas()
+
+    results = dict(
+        json=_time_calls(_json, n_requests),
+        arrow=_time_calls(_arrow, n_requests),
+    )
+
+    for name, seconds in results.items():
+        logger.info("%s: %.3f ms per request", name, seconds * 1000)
+
+    return results
+
+
+def _impute_income_loop(
+    df_income: "pd.DataFrame", df_county_coordinates: "pd.DataFrame"
+) -> "pd.DataFrame":
+    """The original per-county imputation loop of `load_income`, for reference."""
+    import pandas as pd
+    from sklearn.neighbors import NearestNeighbors
+
+    income_is_known = df_county_coordinates["county_fips"].isin(
+        df_income["county_fips"]
+    )
+    df_coords_income_known = df_county_coordinates.loc[income_is_known].reset_index()
+    df_coords_income_not_known = df_county_coordinates.loc[
+        ~income_is_known
+    ].reset_index()
+
+    neighbors_model = NearestNeighbors(n_neighbors=3, metric="haversine")
+    neighbors_model.fit(df_coords_income_known[["lat", "lng"]])
+
+    _, indices = neighbors_model.kneighbors(df_coords_income_not_known[["lat", "lng"]])
+    all_imputed_incomes = []
+    for i, matching_indices in enumerate(indices):
+        matching_counties = df_coords_income_known.iloc[matching_indices]["county_fips"]
+        imputed_income = (
+            df_income[df_income["county_fips"].isin(matching_counties)]
+            .drop(["county_fips"], axis=1)
+            .mean()
+        ).to_dict()
+
+        imputed_income["county_fips"] = int(
+            df_coords_income_not_known.iloc[i]["county_fips"]
+        )
+
+        all_imputed_incomes.append(imputed_income)
+    df_all_imputed_incomes = pd.DataFrame(all_imputed_incomes)
+
+    return pd.concat([df_income, df_all_imputed_incomes])
+
+
+def benchmark_income_imputation(
+    n_counties: int = 3200, known_fraction: float = 0.4, n_calls: int = 3
+) -> Dict[str, float]:
+    """Compare the vectorized income imputation with the original per-county loop.
+
+    Runs on synthetic counties, so it does not depend on the raw datasets.
+    """
+    import numpy as np
+    import pandas as pd
+    from datasets import data_processing
+
+    rng = np.random.default_rng(0)
+    df_county_coordinates = pd.DataFrame(
+        dict(
+            county_fips=np.arange(n_counties) + 1001,
+            lng=rng.uniform(-125, -67, n_counties),
+            lat=rng.uniform(25, 49, n_counties),
+        )
+    )
+    df_income = (
+        df_county_coordinates[["county_fips"]]
+        .sample(frac=known_fraction, random_state=0)
+        .assign(A_MEDIAN=lambda df: rng.uniform(30_000, 120_000, len(df)))
+        .reset_index(drop=True)
+    )
+
+    pd.testing.assert_frame_equal(
+        data_processing._impute_income(df_income, df_county_coordinates),
+        _impute_income_loop(df_income, df_county_coordinates),
+    )
+    results = dict(
+        loop=_time_calls(
+            lambda: _impute_income_loop(df_income, df_county_coordinates), n_calls
+        ),
+        vectorized=_time_calls(
+            lambda: data_processing._impute_income(df_income, df_county_coordinates),
+            n_calls,
+        ),
+    )
+    results["speedup"] = results["loop"] / results["vectorized"]
+
+    logger.info("loop: %.3f s per call", results["loop"])
+    logger.info("vectorized: %.3f s per call", results["vectorized"])
+    logger.info("speedup: %.1fx", results["speedup"])
+
+    return results
+
+
+def benchmark_cache_storage(n_calls: int = 20) -> Dict[str, Dict[str, float]]:
+    """Compare the load latency and RSS of each cached dataset for each storage.
+
+    Every dataset is loaded through its `load_*` wrapper once, then written with each
+    storage backend to a temporary folder and read back.
+    """
+    import tempfile
+    import datasets
+
+    loaders = dict(
+        uscities=datasets.load_uscities,
+        income=lambda: datasets.load_income(occupation_title="All Occupations"),
+        rent=datasets.load_rent,
+        house_prices=datasets.load_house_prices,
+        labor_shed=datasets.load_labor_shed,
+        age_and_gender_data=datasets.load_age_and_gender_data,
+        climate=datasets.load_climate_data,
+        education=datasets.load_education,
+        political=datasets.load_political,
+    )
+    storages = dict(parquet=datasets.PARQUET, feather=datasets.FEATHER)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for name, loader in loaders.items():
+            df = loader()
+            for storage_name, storage in storages.items():
+                filepath = os.path.join(folder, name + storage.extension)
+                storage.write(df, filepath)
+                seconds = _time_calls(lambda: storage.read(filepath), n_calls)
+
+                gc.collect()
+                rss_before = _rss_bytes()
+                df_read = storage.read(filepath)
+                rss = _rss_bytes() - rss_before
+                del df_read
+
+                results[f"{name}/{storage_name}"] = dict(seconds=seconds, rss=rss)
+                logger.info(
+                    "%s/%s: %.3f ms per load, %.1f KiB RSS",
+                    name,
+                    storage_name,
+                    seconds * 1000,
+                    rss / 1024,
+                )
+
+    return results
+
+
+def _merge_base_input_data_chain() -> "pd.DataFrame":
+    """The original chain of merges of the base input data, for reference."""
+    import datasets
+
+    df_input = datasets.load_uscities()
+    df_input = df_input.merge(
+        right=datasets.load_climate_data(),
+        left_on=["city", "state_id"],
+        right_on=["city", "state_id"],
+        how="inner",
+    )
+    df_input = df_input.merge(
+        right=datasets.load_labor_shed(),
+        left_on="county_fips",
+        right_on="FIPS",
+        how="inner",
+    )
+    for load in (
+        datasets.load_age_and_gender_data,
+        datasets.load_rent,
+        datasets.load_house_prices,
+        datasets.load_education,
+        datasets.load_political,
+    ):
+        df_input = df_input.merge(right=load(), on="county_fips", how="inner")
+
+    return df_input
+
+
+def benchmark_base_input_merge(n_calls: int = 5) -> Dict[str, Dict[str, float]]:
+    """Compare the peak memory and wall time of merging the base input data.
+
+    The original chain of merges is compared with the county fips indexed join. The
+    cached datasets are loaded once beforehand, so only the merge itself is measured.
+    """
+    import tracemalloc
+    import datasets
+
+    merges = dict(
+        chain=_merge_base_input_data_chain,
+        indexed=datasets._merge_base_input_data,
+    )
+    for dataset in datasets.load_base_input_data.dependencies:
+        dataset()
+
+    results = {}
+    for name, merge in merges.items():
+        seconds = _time_calls(merge, n_calls)
+
+        gc.collect()
+        tracemalloc.start()
+        df_input = merge()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results[name] = dict(
+            seconds=seconds,
+            peak=peak,
+            size=df_input.memory_usage(deep=True).sum(),
+        )
+        logger.info(
+            "%s: %.1f ms per merge, %.1f MiB peak, %.1f MiB result",
+            name,
+            seconds * 1000,
+            peak / 2**20,
+            results[name]["size"] / 2**20,
+        )
+
+    return results
+
+
+def benchmark_import_time(
+    module: str = "tabpy_loader", n_runs: int = 5
+) -> Dict[str, float]:
+    """Measure the cold import time of the serving path with `python -X importtime`.
+
+    Each run imports `module` in a fresh interpreter. That the import does not pull
+    in the packages only needed to rebuild the cache is tested in
+    `tests/test_import_time.py`.
+    """
+    import statistics
+    import subprocess
+
+    all_seconds = []
+    for _ in range(n_runs):
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        # Lines look like "import time: self [us] | cumulative | imported package"
+        imported = {}
+        for line in completed.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line[len("import time:") :].split("|")
+            imported[name.strip()] = int(cumulative) / 1e6
+        all_seconds.append(imported[module])
+
+    results = dict(
+        median=statistics.median(all_seconds),
+        min=min(all_seconds),
+        max=max(all_seconds),
+    )
+    for name, seconds in results.items():
+        logger.info("%s: %.3f s to import %s", name, seconds, module)
+
+    return results
+
+
+def benchmark_load_test(
+    concurrency_levels: tuple = (1, 2, 4, 8, 16),
+    n_requests: int = 400,
+    city_id: int = CITY_ID,
+) -> Dict[int, Dict[str, float]]:
+    """Measure the latency percentiles and throughput of the service under load.
+
+    For each concurrency level, that many clients send `n_requests` ranking requests
+    between them, each client with its own keep-alive session. The sliders of every
+    request are random, so requests miss the similarity cache.
+    """
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+    import requests
+    from tabpy_loader import SLIDER_NAMES
+
+    url = f"{FLASK_URL}/rank_similar_cities/"
+    clients = threading.local()
+
+    def _request(seed: int) -> float:
+        if not hasattr(clients, "session"):
+            clients.session = requests.Session()
+        sliders = np.random.default_rng(seed).uniform(0, 1, len(SLIDER_NAMES))
+        data = dict(
+            cities=[city_id],
+            city_id=city_id,
+            occupation_title="All Occupations",
+            **dict(zip(SLIDER_NAMES, sliders.round(2))),
+        )
+
+        start = time.perf_counter()
+        clients.session.post(url, data=data).raise_for_status()
+        return time.perf_counter() - start
+
+    results = {}
+    for concurrency in concurrency_levels:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            start = time.perf_counter()
+            latencies = np.fromiter(
+                executor.map(_request, range(n_requests)), dtype=float
+            )
+            seconds = time.perf_counter() - start
+
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        results[concurrency] = dict(
+            p50=p50, p95=p95, p99=p99, requests_per_second=n_requests / seconds
+        )
+        logger.info(
+            "%d clients: p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, %.1f requests/s",
+            concurrency,
+            p50 * 1000,
+            p95 * 1000,
+            p99 * 1000,
+            n_requests / seconds,
+        )
+
+    return results
+
+
+def benchmark_indexed_search(
+    n_cities: tuple = (30_000, 100_000, 300_000),
+    n_queries: int = 100,
+    limit: int = 30,
+) -> Dict[int, Dict[str, float]]:
+    """Compare the recall and latency of the FeatureIndex with a brute force scan.
+
+    Runs on synthetic clustered features, so larger city tables than the bundled US
+    city list can be measured. Every query has random feature weights. Recall is the
+    fraction of the brute force top `limit` cities also returned by the index.
+    """
+    import numpy as np
+    import similar_cities
+
+    rng = np.random.default_rng(0)
+    results = {}
+    for n in n_cities:
+        centers = rng.random((64, 15))
+        matrix = centers[rng.integers(0, len(centers), n)]
+        matrix = (matrix + rng.normal(0, 0.05, matrix.shape)).astype(np.float32)
+
+        start = time.perf_counter()
+        index = similar_cities.FeatureIndex(matrix)
+        build_seconds = time.perf_counter() - start
+
+        brute_seconds, index_seconds, recall = 0.0, 0.0, 0.0
+        for _ in range(n_queries):
+            position = rng.integers(n)
+            feature_weights = rng.random(15).astype(np.float32)
+
+            start = time.perf_counter()
+            distances = similar_cities.weighted_distances(
+                matrix, position, feature_weights
+            )
+            expected = similar_cities.smallest_positions(distances, limit=limit)
+            brute_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            rows, _ = index.query(matrix[position], limit, feature_weights)
+            index_seconds += time.perf_counter() - start
+
+            recall += len(np.intersect1d(rows, expected)) / limit
+
+        results[n] = dict(
+            build_seconds=build_seconds,
+            brute_seconds=brute_seconds / n_queries,
+            index_seconds=index_seconds / n_queries,
+            recall=recall / n_queries,
+        )
+        logger.info(
+            "%d cities: brute %.2f ms, index %.2f ms per query, recall %.4f, "
+            + "build %.2f s",
+            n,
+            results[n]["brute_seconds"] * 1000,
+            results[n]["index_seconds"] * 1000,
+            results[n]["recall"],
+            build_seconds,
+        )
+
+    return results
+
+
+def benchmark_anchor_reweighting(
+    n_cities: int = 30_000, n_slider_changes: int = 200
+) -> Dict[str, float]:
+    """Compare recomputing the distances to a city with reweighting its differences.
+
+    Simulates a user dragging sliders for a single selected city, on synthetic
+    features. Also reports the memory an anchor city takes in `AnchorDifferences`.
+    """
+    import numpy as np
+    import similar_cities
+
+    rng = np.random.default_rng(0)
+    features = similar_cities.ScaledFeatures(
+        city_ids=np.arange(n_cities),
+        matrix=rng.random((n_cities, 15), dtype=np.float32),
+        feature_names=[f"feature_{i}" for i in range(15)],
+    )
+    all_feature_weights = rng.random((n_slider_changes, 15)).astype(np.float32)
+    anchor_differences = similar_cities.AnchorDifferences()
+
+    def _recompute():
+        for feature_weights in all_feature_weights:
+            similar_cities.weighted_distances(features.matrix, 0, feature_weights)
+
+    def _reweight():
+        for feature_weights in all_feature_weights:
+            anchor_differences.distances(features, 0, feature_weights)
+
+    np.testing.assert_allclose(
+        anchor_differences.distances(features, 0, all_feature_weights[0]),
+        similar_cities.weighted_distances(features.matrix, 0, all_feature_weights[0]),
+        rtol=1e-5,
+    )
+    results = dict(
+        recompute=_time_calls(_recompute, 1) / n_slider_changes,
+        reweight=_time_calls(_reweight, 1) / n_slider_changes,
+        bytes_per_anchor=anchor_differences.stats()["bytes"],
+    )
+
+    logger.info("recompute: %.3f ms per slider change", results["recompute"] * 1000)
+    logger.info("reweight: %.3f ms per slider change", results["reweight"] * 1000)
+    logger.info("memory: %.1f MiB per anchor", results["bytes_per_anchor"] / 2**20)
+
+    return results
+
+
+def benchmark_top_similar_cities(
+    n_cities: int = 30_000,
+    chunk_sizes: tuple = (8, 16, 64, 256),
+    n_lookups: int = 1000,
+    limit: int = 30,
+) -> Dict[str, float]:
+    """Measure the build time of `TopSimilarCities` per chunk size, and its lookups.
+
+    Runs on synthetic features. Lookups of the default sliders are compared with
+    computing the distances to every city.
+    """
+    import tempfile
+    import numpy as np
+    import similar_cities
+
+    rng = np.random.default_rng(0)
+    features = similar_cities.ScaledFeatures(
+        city_ids=np.arange(n_cities),
+        matrix=rng.random((n_cities, 15), dtype=np.float32),
+        feature_names=[f"feature_{i}" for i in range(15)],
+    )
+
+    results = {}
+    for chunk_size in chunk_sizes:
+        top_similar_cities = similar_cities.TopSimilarCities(
+            feature_store=None, chunk_size=chunk_size
+        )
+        seconds = _time_calls(lambda: top_similar_cities.compute(features), 1)
+        results[f"build/{chunk_size}"] = seconds
+        logger.info(
+            "build with chunks of %d: %.2f s, %.1f MiB per chunk",
+            chunk_size,
+            seconds,
+            2 * chunk_size * n_cities * 4 / 2**20,
+        )
+
+    with tempfile.TemporaryDirectory() as folder:
+        feature_store = similar_cities.FeatureStore(cache_folder=folder)
+        feature_store._features["All Occupations"] = features
+        top_similar_cities = similar_cities.TopSimilarCities(feature_store)
+        top_similar_cities.load()
+
+        city_ids = rng.choice(features.city_ids, n_lookups)
+        results["lookup"] = _time_calls(
+            lambda: [
+                top_similar_cities.lookup(city_id, "All Occupations", [1.0] * 15, limit)
+                for city_id in city_ids
+            ],
+            1,
+        ) / len(city_ids)
+        results["compute"] = (
+            _time_calls(
+                lambda: [
+                    similar_cities.smallest_positions(
+                        similar_cities.weighted_distances(
+                            features.matrix, features.position(city_id)
+                        ),
+                        limit=limit,
+                    )
+                    for city_id in city_ids[:100]
+                ],
+                1,
+            )
+            / 100
+        )
+        # Release the memory maps before the folder is removed
+        top_similar_cities = None
+
+    logger.info("lookup: %.3f ms per request", results["lookup"] * 1000)
+    logger.info("compute: %.3f ms per request", results["compute"] * 1000)
+
+    return results
+
+
+def benchmark_parallel_distances(
+    n_cities: int = 300_000,
+    n_queries: int = 16,
+    worker_counts: tuple = (1, 2, 4, 8),
+    n_calls: int = 10,
+) -> Dict[int, Dict[str, float]]:
+    """Measure how the `DistancePool` scales with its number of workers.
+
+    Runs on synthetic features, for a single query missing every cache as served by
+    `/rank_similar_cities/` (computing the differences to the city, then weighting
+    them), and for a batch of queries. The speedup is relative to a single worker,
+    and is bound by the number of cores.
+    """
+    import numpy as np
+    import similar_cities
+
+    rng = np.random.default_rng(0)
+    features = similar_cities.ScaledFeatures(
+        city_ids=np.arange(n_cities),
+        matrix=rng.random((n_cities, 15), dtype=np.float32),
+        feature_names=[f"feature_{i}" for i in range(15)],
+    )
+    feature_weights = rng.random(15).astype(np.float32)
+    positions = rng.integers(n_cities, size=n_queries)
+    logger.info("%d cores available", os.cpu_count())
+
+    results = {}
+    for n_workers in worker_counts:
+        pool = similar_cities.DistancePool(n_workers=n_workers)
+        results[n_workers] = dict(
+            single=_time_calls(
+                lambda: similar_cities.AnchorDifferences(pool=pool).distances(
+                    features, 0, feature_weights
+                ),
+                n_calls,
+            ),
+            batch=_time_calls(
+                lambda: pool.batch_weighted_distances(
+                    features.matrix, positions, feature_weights
+                ),
+                n_calls,
+            ),
+        )
+        logger.info(
+            "%d workers: single %.2f ms (%.1fx), batch of %d %.2f ms (%.1fx)",
+            n_workers,
+            results[n_workers]["single"] * 1000,
+            results[worker_counts[0]]["single"] / results[n_workers]["single"],
+            n_queries,
+            results[n_workers]["batch"] * 1000,
+            results[worker_counts[0]]["batch"] / results[n_workers]["batch"],
+        )
+
+    return results
+
+
+BENCHMARKS = dict(
+    connection_reuse=benchmark_connection_reuse,
+    response_format=benchmark_response_format,
+    income_imputation=benchmark_income_imputation,
+    cache_storage=benchmark_cache_storage,
+    base_input_merge=benchmark_base_input_merge,
+    import_time=benchmark_import_time,
+    load_test=benchmark_load_test,
+    indexed_search=benchmark_indexed_search,
+    anchor_reweighting=benchmark_anchor_reweighting,
+    top_similar_cities=benchmark_top_similar_cities,
+    parallel_distances=benchmark_parallel_distances,
+)
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        logger.info("Running benchmark: %s", name)
+        BENCHMARKS[name]()
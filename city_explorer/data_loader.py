@@ -36,75 +36,23 @@ def load_input_data(
         logger.info(formatted_help_msg)
         return
     else:
-        # Load all data
-        reset_cache = not use_cache
-        df_uscities = datasets.load_uscities(reset_cache=reset_cache)
-        df_laborshed = datasets.load_labor_shed(reset_cache=reset_cache)
-        df_age_and_gender = datasets.load_age_and_gender_data(reset_cache=reset_cache)
-        df_rent = datasets.load_rent(reset_cache=reset_cache)
-        df_income = datasets.load_income(
-            reset_cache=reset_cache,
-            occupation_title=occupation_title,
-        )
-        df_house_prices = datasets.load_house_prices(reset_cache=reset_cache)
-        df_climate = datasets.load_climate_data(reset_cache=reset_cache)
-        df_political = datasets.load_political(reset_cache=reset_cache)
-        df_education = datasets.load_education(reset_cache=reset_cache)
+        if not use_cache:
+            datasets.reset_cache(force=True)
 
-        # Merge all datasets together
-        df_input = df_uscities.copy()
-        df_input = df_input.merge(
-            right=df_climate,
-            left_on=["city", "state_id"],
-            right_on=["city", "state_id"],
-            how="inner",
-        )
-        df_input = df_input.merge(
-            right=df_laborshed,
-            left_on="county_fips",
-            right_on="FIPS",
-            how="inner",
-        )
-        df_input = df_input.merge(
-            right=df_age_and_gender,
-            left_on="county_fips",
-            right_on="county_fips",
-            how="inner",
-        )
-        df_input = df_input.merge(
-            right=df_rent,
-            left_on="county_fips",
-            right_on="county_fips",
-            how="inner",
-        )
-        df_input = df_input.merge(
-            right=df_income,
-            left_on="county_fips",
-            right_on="county_fips",
-            how="inner",
-        )
-        df_input = df_input.merge(
-            right=df_house_prices,
-            left_on="county_fips",
-            right_on="county_fips",
-            how="inner",
-        )
-        df_input = df_input.merge(
-            right=df_education,
-            left_on="county_fips",
-            right_on="county_fips",
-            how="inner",
-        )
-        df_input = df_input.merge(
-            right=df_political,
-            left_on="county_fips",
-            right_on="county_fips",
-            how="inner",
-        )
+        # Every dataset except income is merged ahead of time into the base dataset
+        df_input = datasets.load_base_input_data()
+        df_income = datasets.load_income(occupation_title=occupation_title)
+
+        # Look up the income of each city's county
+        income = df_income.set_index("county_fips")["A_MEDIAN"]
+        df_input["A_MEDIAN"] = df_input["county_fips"].map(income)
 
         # Compute income surplus
         df_input["income_surplus"] = (
             df_input["A_MEDIAN"] - df_input["home_price_5yr_median"] / 30
         )
 
+        # Only keep cities with an income
+        df_input = df_input[df_input["A_MEDIAN"].notna()]
+
     return df_input
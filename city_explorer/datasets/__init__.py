@@ -1,34 +1,279 @@
 """Module to contain all data loaders specific to each dataset."""
+import hashlib
+import inspect
+import json
 import os
 import shutil
-from typing import Callable
-import functools
+import threading
+from collections import OrderedDict
+from types import CodeType
+from typing import Callable, Dict, Iterator, List
 import logging
-from joblib import Parallel, delayed
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 CACHE_FOLDER = os.path.join(os.path.dirname(__file__), "cache")
 DATA_CACHE_FOLDER = os.path.join(CACHE_FOLDER, "data")
+MANIFEST_FILENAME = "manifest.json"
+_manifest_lock = threading.Lock()
 
 from . import data_processing
 from .data_processing import unique_occupations
 
 
+def _file_hash(filepath: str) -> str:
+    """Return the sha256 hash of the content of a file, or None if it does not exist."""
+    if not os.path.exists(filepath):
+        return None
+
+    hasher = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        for chunk in iter(lambda: file.read(2**20), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def _referenced_names(code: CodeType) -> Iterator[str]:
+    """Yield the global names referenced by the code, including nested code."""
+    yield from code.co_names
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            yield from _referenced_names(const)
+
+
+def _code_hash(func: Callable) -> str:
+    """Return the sha256 hash of the source of a function.
+
+    The source of every function of the same module that it references, directly or
+    indirectly, is included in the hash.
+    """
+    hasher = hashlib.sha256()
+    visited = set()
+    to_visit = [func]
+    while to_visit:
+        func = to_visit.pop()
+        if func in visited:
+            continue
+        visited.add(func)
+
+        hasher.update(inspect.getsource(func).encode())
+        for name in sorted(set(_referenced_names(func.__code__))):
+            referenced = func.__globals__.get(name)
+            if (
+                inspect.isfunction(referenced)
+                and referenced.__module__ == func.__module__
+            ):
+                to_visit.append(referenced)
+
+    return hasher.hexdigest()
+
+
+def write_atomically(filepath: str, write: Callable[[str], None]):
+    """Write a file to a temporary file first, which then replaces it in one step.
+
+    Readers never see a partially written file, and processes which memory-mapped the
+    previous file keep reading it, rather than crashing once it is truncated.
+
+    Parameters
+    ----------
+    filepath : str
+        The file to write.
+
+    write : Callable[[str], None]
+        A function which writes the content to the filepath it is given.
+    """
+    temporary_filepath = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write(temporary_filepath)
+        os.replace(temporary_filepath, filepath)
+    finally:
+        if os.path.exists(temporary_filepath):
+            os.remove(temporary_filepath)
+
+
+class ParquetStorage:
+    """Store cached datasets as compressed parquet files."""
+
+    extension = ".parquet"
+
+    def write(self, df: pd.DataFrame, filepath: str):
+        """Write the dataset to the file."""
+        write_atomically(filepath, df.to_parquet)
+
+    def read(self, filepath: str) -> pd.DataFrame:
+        """Read the dataset from the file."""
+        return pd.read_parquet(filepath)
+
+
+class FeatherStorage:
+    """Store cached datasets as uncompressed Arrow IPC (feather) files.
+
+    Files are memory-mapped on read, so numeric columns are not copied or decoded.
+    Each file holds a single record batch, as columns split over several batches are
+    copied into one array when converted to pandas.
+    """
+
+    extension = ".feather"
+
+    def write(self, df: pd.DataFrame, filepath: str):
+        """Write the dataset to the file."""
+        table = pa.Table.from_pandas(df)
+        write_atomically(
+            filepath,
+            lambda temporary_filepath: feather.write_feather(
+                table,
+                temporary_filepath,
+                compression="uncompressed",
+                chunksize=max(len(df), 1),
+            ),
+        )
+
+    def read(self, filepath: str) -> pd.DataFrame:
+        """Read the dataset from the file."""
+        table = feather.read_table(filepath, memory_map=True)
+        return table.to_pandas(split_blocks=True)
+
+
+PARQUET = ParquetStorage()
+FEATHER = FeatherStorage()
+
+
 class CachedData:
-    """A class which wraps a data_loader function and enables datacaching."""
+    """A class which wraps a data_loader function and enables datacaching.
+
+    Loaded datasets are also memoized in memory, so repeated calls within a process
+    do not read the cache again. A memoized dataset is invalidated, and its cache
+    rebuilt, once one of its source files changes.
+    """
+
+    # Memo of loaded datasets shared by every CachedData, in least recently used order
+    max_memo_entries = 32
+    _memo: "OrderedDict[tuple, pd.DataFrame]" = OrderedDict()
+    _memo_lock = threading.Lock()
 
     def __init__(
         self,
         func: Callable,
         data_cache_filepath: str,
+        storage: ParquetStorage = PARQUET,
+        source_files: List[str] = (),
+        dependencies: List["CachedData"] = (),
     ):
-        """Initialize a CachedData object cached datset."""
+        """Initialize a CachedData object cached datset.
+
+        `storage` selects how the dataset is stored in the cache, either `PARQUET` or
+        `FEATHER`. `source_files` are the raw files the dataset is derived from, and
+        `dependencies` the cached datasets it is built from.
+        """
         self.func = func
         self.data_cache_filepath = os.path.join(DATA_CACHE_FOLDER, data_cache_filepath)
+        self.storage = storage
+        self.source_files = list(source_files)
+        self.dependencies = list(dependencies)
+        # The source signature each cache was last found unchanged with, by filepath
+        self._verified_signatures: Dict[str, tuple] = {}
+
+    def _all_source_files(self) -> List[str]:
+        """Return the source files of the dataset and of its dependencies."""
+        all_source_files = list(self.source_files)
+        for dependency in self.dependencies:
+            for source_file in dependency._all_source_files():
+                if source_file not in all_source_files:
+                    all_source_files.append(source_file)
+
+        return all_source_files
+
+    @property
+    def cache_filename(self) -> str:
+        """The name of the cache file of the dataset."""
+        return os.path.basename(self._datacache_filepath(args=(), kws={}))
+
+    def fingerprint(self) -> Dict[str, object]:
+        """Return the content hash of each source file and of the code of the dataset.
+
+        The dataset only needs to be rebuilt when its fingerprint changes.
+        """
+        return dict(
+            sources={
+                os.path.basename(source_file): _file_hash(source_file)
+                for source_file in self.source_files
+            },
+            code=_code_hash(self.func),
+            dependencies={
+                dependency.cache_filename: dependency.fingerprint()
+                for dependency in self.dependencies
+            },
+        )
+
+    def _source_signature(self) -> tuple:
+        """Return the modification time and size of each source file."""
+        signature = []
+        for source_file in self._all_source_files():
+            try:
+                stat = os.stat(source_file)
+                signature.append((source_file, stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append((source_file, None, None))
+
+        return tuple(signature)
+
+    def _is_stale(self, data_cache_filepath: str) -> bool:
+        """Return whether the inputs of the dataset changed after the cache was written.
+
+        Only once a source file was modified after the cache is the fingerprint of
+        the dataset compared with the manifest, so a source file which was touched
+        but not changed, e.g. by a checkout, does not rebuild the cache.
+        """
+        cache_mtime = os.stat(data_cache_filepath).st_mtime_ns
+        signature = self._source_signature()
+        if not any(
+            mtime is not None and mtime > cache_mtime for _, mtime, _ in signature
+        ):
+            return False
+        if self._verified_signatures.get(data_cache_filepath) == signature:
+            return False
+
+        fingerprint = _read_manifest().get(os.path.basename(data_cache_filepath))
+        if fingerprint != self.fingerprint():
+            return True
+
+        self._verified_signatures[data_cache_filepath] = signature
+        return False
+
+    def _record_fingerprint(self, data_cache_filepath: str):
+        """Record the fingerprint the cache was just built from in the manifest."""
+        with _manifest_lock:
+            manifest = _read_manifest()
+            manifest[os.path.basename(data_cache_filepath)] = self.fingerprint()
+            _write_manifest(manifest)
+
+    @classmethod
+    def _memo_get(cls, key: tuple) -> pd.DataFrame:
+        """Return a memoized dataset, or None if it is not memoized."""
+        with cls._memo_lock:
+            df = cls._memo.get(key)
+            if df is None:
+                return None
+            cls._memo.move_to_end(key)
+
+        # Shallow copy, so callers adding columns do not modify the memoized dataset
+        return df.copy(deep=False)
+
+    @classmethod
+    def _memo_put(cls, key: tuple, df: pd.DataFrame):
+        """Memoize a dataset, evicting the least recently used datasets."""
+        with cls._memo_lock:
+            cls._memo[key] = df
+            cls._memo.move_to_end(key)
+            while len(cls._memo) > cls.max_memo_entries:
+                cls._memo.popitem(last=False)
 
     def _datacache_filepath(self, args, kws):
         """Compute the datacache filepath"""
@@ -41,14 +286,24 @@ class CachedData:
             ).lower()
             data_cache_filepath += "__" + occupation_title
 
-        data_cache_filepath += ".parquet"
+        data_cache_filepath += self.storage.extension
         return data_cache_filepath
 
     def __call__(self, reset_cache: bool = False, *args, **kws):
         """Call the function and load the dataset."""
         data_cache_filepath = self._datacache_filepath(args=args, kws=kws)
+        memo_key = (data_cache_filepath, self._source_signature())
+
+        if not reset_cache:
+            df = self._memo_get(memo_key)
+            if df is not None:
+                return df
 
-        if reset_cache or not os.path.exists(data_cache_filepath):
+        if (
+            reset_cache
+            or not os.path.exists(data_cache_filepath)
+            or self._is_stale(data_cache_filepath)
+        ):
             msg = (
                 f"Loading data for {self.data_cache_filepath}"
                 + f" with the following args and kws {args}, {kws}"
@@ -58,77 +313,386 @@ class CachedData:
             df: pd.DataFrame = self.func(*args, **kws)
             if not os.path.exists(DATA_CACHE_FOLDER):
                 os.makedirs(DATA_CACHE_FOLDER)
-            df.to_parquet(data_cache_filepath)
+            self.storage.write(df, data_cache_filepath)
+            self._record_fingerprint(data_cache_filepath)
         else:
             logger.info("Reading data from cache: %s", data_cache_filepath)
-            df = pd.read_parquet(data_cache_filepath)
+            df = self.storage.read(data_cache_filepath)
 
-        return df
+        self._memo_put(memo_key, df)
+        return df.copy(deep=False)
+
+
+class ColumnarIncomeData(CachedData):
+    """A CachedData for the income of every occupation, stored in a single file.
+
+    The file is keyed by `county_fips` with one column per occupation code, and keeps
+    the mapping from occupation title to code in its metadata. Loading the income of
+    an occupation only reads its column, from a file that stays open (and optionally
+    memory-mapped) between calls.
+    """
+
+    def __init__(
+        self,
+        func: Callable,
+        data_cache_filepath: str,
+        memory_map: bool = True,
+        source_files: List[str] = (),
+        dependencies: List[CachedData] = (),
+    ):
+        """Initialize a ColumnarIncomeData object.
+
+        `func` must return a (county x occupation) dataframe indexed by `county_fips`
+        with one column per occupation title, see
+        `data_processing.load_income_all_occupations`.
+        """
+        super().__init__(
+            func=func,
+            data_cache_filepath=data_cache_filepath,
+            source_files=source_files,
+            dependencies=dependencies,
+        )
+        self.memory_map = memory_map
+        self._parquet_file = None
+        self._parquet_file_mtime = None
+        self._occupation_codes = None
+        self._lock = threading.Lock()
+
+    def _datacache_filepath(self, args, kws):
+        """Compute the datacache filepath. All occupations share the same file."""
+        return self.data_cache_filepath + ".parquet"
+
+    def _build(self, data_cache_filepath: str):
+        """Compute the income of every occupation and write it to the cache."""
+        logger.info("Loading data for %s", self.data_cache_filepath)
+        df_income: pd.DataFrame = self.func()
+
+        all_occupation_codes = data_processing.occupation_codes()
+        occupation_codes = {
+            occupation_title: all_occupation_codes[occupation_title]
+            for occupation_title in df_income.columns
+        }
+        df_income = df_income.rename(columns=occupation_codes).reset_index()
+
+        table = pa.Table.from_pandas(df_income, preserve_index=False)
+        metadata = {
+            **(table.schema.metadata or {}),
+            b"occupation_codes": json.dumps(occupation_codes).encode(),
+        }
+        if not os.path.exists(DATA_CACHE_FOLDER):
+            os.makedirs(DATA_CACHE_FOLDER)
+        write_atomically(
+            data_cache_filepath,
+            lambda temporary_filepath: pq.write_table(
+                table.replace_schema_metadata(metadata), temporary_filepath
+            ),
+        )
+        self._record_fingerprint(data_cache_filepath)
+
+    def __call__(
+        self, reset_cache: bool = False, occupation_title: str = "All Occupations"
+    ) -> pd.DataFrame:
+        """Load the income of an occupation."""
+        data_cache_filepath = self._datacache_filepath(args=(), kws={})
+        memo_key = (data_cache_filepath, occupation_title, self._source_signature())
+
+        if not reset_cache:
+            df_income = self._memo_get(memo_key)
+            if df_income is not None:
+                return df_income
+
+        with self._lock:
+            if (
+                reset_cache
+                or not os.path.exists(data_cache_filepath)
+                or self._is_stale(data_cache_filepath)
+            ):
+                self._parquet_file = None
+                self._build(data_cache_filepath)
+
+            # Reopen the file if it was rebuilt since it was opened
+            mtime = os.stat(data_cache_filepath).st_mtime_ns
+            if self._parquet_file is None or mtime != self._parquet_file_mtime:
+                logger.info("Opening data cache: %s", data_cache_filepath)
+                self._parquet_file = pq.ParquetFile(
+                    data_cache_filepath, memory_map=self.memory_map
+                )
+                self._parquet_file_mtime = mtime
+                self._occupation_codes = json.loads(
+                    self._parquet_file.schema_arrow.metadata[b"occupation_codes"]
+                )
+
+            if occupation_title not in self._occupation_codes:
+                raise ValueError(
+                    f"`{occupation_title}` is not a valid occupation. "
+                    + "Pass 'help' as the occupation title to `load_input_data` to "
+                    + "display all possible values."
+                )
+
+            occupation_code = self._occupation_codes[occupation_title]
+            table = self._parquet_file.read(columns=["county_fips", occupation_code])
+
+        df_income = table.to_pandas().rename(columns={occupation_code: "A_MEDIAN"})
+        df_income = df_income.dropna().reset_index(drop=True)
+
+        self._memo_put(memo_key, df_income)
+        return df_income.copy(deep=False)
 
 
 load_uscities = CachedData(
     func=data_processing.load_uscities,
     data_cache_filepath="us_cities",
+    storage=FEATHER,
+    source_files=[data_processing.USCITIES_FILE],
 )
-load_income = CachedData(
-    func=data_processing.load_income,
+load_income = ColumnarIncomeData(
+    func=data_processing.load_income_all_occupations,
     data_cache_filepath="income",
+    source_files=[
+        data_processing.INCOME_FILE,
+        data_processing.CBSA_TO_COUNTYFIPS_FILE,
+        data_processing.NECTA_TO_COUNTYFIPS_FILE,
+    ],
+    # The county coordinates are computed from the cached cities
+    dependencies=[load_uscities],
 )
 load_rent = CachedData(
     func=data_processing.load_rent,
     data_cache_filepath="rent",
+    storage=FEATHER,
+    source_files=[data_processing.RENT_FILE],
 )
 load_house_prices = CachedData(
     func=data_processing.load_house_prices,
     data_cache_filepath="house_prices",
+    storage=FEATHER,
+    source_files=[data_processing.HOUSE_PRICES_FILE],
 )
 load_labor_shed = CachedData(
     func=data_processing.load_labor_shed,
     data_cache_filepath="labor_shed",
+    storage=FEATHER,
+    source_files=[data_processing.LABOR_SHED_FILE],
 )
 load_age_and_gender_data = CachedData(
     func=data_processing.load_age_and_gender_data,
     data_cache_filepath="age_and_gender_data",
+    storage=FEATHER,
+    source_files=[data_processing.DEMOGRAPHIC_FILE],
 )
 load_climate_data = CachedData(
     func=data_processing.load_climate_data,
     data_cache_filepath="climate",
+    storage=FEATHER,
+    source_files=[data_processing.CLIMATE_FILE],
 )
 load_education = CachedData(
     func=data_processing.load_education,
     data_cache_filepath="education",
+    storage=FEATHER,
+    source_files=[data_processing.EDUCATION_FILE],
 )
 load_political = CachedData(
     func=data_processing.load_political,
     data_cache_filepath="political",
+    storage=FEATHER,
+    source_files=[data_processing.POLITICAL_FILE],
 )
 
 
-def reset_cache(n_jobs: int = 1):
-    """Reset the cached datasets.
+def _county_indexed(df: pd.DataFrame, county_fips_col: str) -> pd.DataFrame:
+    """Index a county level dataset by county fips, keeping one row per county."""
+    df = df.set_index(df[county_fips_col].astype("int64").rename("county_fips"))
+    if county_fips_col == "county_fips":
+        df = df.drop(columns=["county_fips"])
+
+    if not df.index.is_unique:
+        logger.warning("Dropping duplicated counties from %s", list(df.columns))
+        df = df[~df.index.duplicated()]
+
+    return df
 
-    This should be called everytime an update is made.
 
-    NOTE: This function takes ~13 minutes to run with 16 jobs on Cameron's computer.
+def _downcast(df: pd.DataFrame) -> pd.DataFrame:
+    """Downcast floats to float32, and integers to the smallest integer dtype."""
+    dtypes = {col: "float32" for col in df.select_dtypes("float").columns}
+    for col in df.select_dtypes("integer").columns:
+        dtypes[col] = pd.to_numeric(df[col], downcast="integer").dtype
+
+    return df.astype(dtypes)
+
+
+def _merge_base_input_data() -> pd.DataFrame:
+    """Merge every city and county level dataset, except income, by city.
+
+    Income is the only dataset that depends on the occupation, so it is added to the
+    merged dataset when it is loaded, see `data_loader.load_input_data`.
     """
-    funcs = [
+    df_uscities = load_uscities()
+    df_climate = load_climate_data()
+
+    # Combine the county level datasets into a single county fips indexed dataset. An
+    # inner join only keeps the counties present in every dataset.
+    df_counties = pd.concat(
+        [
+            _county_indexed(load_labor_shed(), county_fips_col="FIPS"),
+            _county_indexed(load_age_and_gender_data(), county_fips_col="county_fips"),
+            _county_indexed(load_rent(), county_fips_col="county_fips"),
+            _county_indexed(load_house_prices(), county_fips_col="county_fips"),
+            _county_indexed(load_education(), county_fips_col="county_fips"),
+            _county_indexed(load_political(), county_fips_col="county_fips"),
+        ],
+        axis=1,
+        join="inner",
+    )
+
+    # Join the cities to their climate, then to their county in a single step
+    df_input = df_uscities.merge(
+        right=df_climate,
+        left_on=["city", "state_id"],
+        right_on=["city", "state_id"],
+        how="inner",
+    )
+    df_input = df_input.join(df_counties, on="county_fips", how="inner")
+
+    return _downcast(df_input.reset_index(drop=True))
+
+
+load_base_input_data = CachedData(
+    func=_merge_base_input_data,
+    data_cache_filepath="input_base",
+    storage=FEATHER,
+    dependencies=[
         load_uscities,
-        load_rent,
-        load_house_prices,
+        load_climate_data,
         load_labor_shed,
         load_age_and_gender_data,
-        load_climate_data,
+        load_rent,
+        load_house_prices,
         load_education,
         load_political,
-    ]
-    income_funcs = [
-        functools.partial(load_income, occupation_title=occupation)
-        for occupation in unique_occupations()
-    ]
+    ],
+)
+
+
+# Every cached dataset. Datasets with dependencies are last, after what they are
+# built from.
+CACHED_DATASETS = [
+    load_uscities,
+    load_rent,
+    load_house_prices,
+    load_labor_shed,
+    load_age_and_gender_data,
+    load_climate_data,
+    load_education,
+    load_political,
+    load_base_input_data,
+    load_income,
+]
+
+
+def _read_manifest() -> Dict[str, Dict[str, object]]:
+    """Return the fingerprint of each cached dataset when it was last built."""
+    manifest_filepath = os.path.join(DATA_CACHE_FOLDER, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_filepath):
+        return {}
+
+    with open(manifest_filepath) as file:
+        return json.load(file)
+
+
+def _write_manifest(manifest: Dict[str, Dict[str, object]]):
+    """Write the fingerprint of each cached dataset."""
+    if not os.path.exists(DATA_CACHE_FOLDER):
+        os.makedirs(DATA_CACHE_FOLDER)
+
+    def _write(filepath: str):
+        with open(filepath, "w") as file:
+            json.dump(manifest, file, indent=2, sort_keys=True)
+
+    write_atomically(os.path.join(DATA_CACHE_FOLDER, MANIFEST_FILENAME), _write)
+
+
+def reset_cache(
+    n_jobs: int = 1, dry_run: bool = False, force: bool = False
+) -> List[str]:
+    """Rebuild the cached datasets whose inputs changed.
+
+    This should be called everytime an update is made.
 
-    if os.path.exists(DATA_CACHE_FOLDER):
+    A manifest alongside the cache records the content hash of the source files and
+    code each dataset was built from, see `CachedData.fingerprint`. Only datasets
+    whose fingerprint changed, or whose cache is missing, are rebuilt. A dataset's
+    fingerprint includes the fingerprints of its dependencies.
+
+    The income of every occupation is built in a single pass into a single file, see
+    `ColumnarIncomeData`.
+
+    Parameters
+    ----------
+    n_jobs : int, optional
+        The number of datasets to rebuild in parallel. Default is 1.
+
+    dry_run : bool, optional
+        Only report which datasets would be rebuilt. Default is False.
+
+    force : bool, optional
+        Delete the cache and rebuild every dataset. Default is False.
+
+    Returns
+    -------
+    List[str]
+        The cache file of each dataset that was (or would be) rebuilt.
+    """
+    manifest = {} if force else _read_manifest()
+
+    stale_datasets = []
+    fingerprints = {}
+    for dataset in CACHED_DATASETS:
+        name = dataset.cache_filename
+        fingerprints[name] = dataset.fingerprint()
+        cache_exists = os.path.exists(os.path.join(DATA_CACHE_FOLDER, name))
+
+        if cache_exists and manifest.get(name) == fingerprints[name]:
+            continue
+        if (
+            cache_exists
+            and None in fingerprints[name]["sources"].values()
+            and not force
+        ):
+            logger.warning("Not rebuilding %s, its source files are missing.", name)
+            continue
+
+        stale_datasets.append(dataset)
+
+    stale_names = [dataset.cache_filename for dataset in stale_datasets]
+    for name in stale_names:
+        logger.info("%s %s", "Would rebuild" if dry_run else "Rebuilding", name)
+
+    if dry_run or not stale_datasets:
+        return stale_names
+
+    if force and os.path.exists(DATA_CACHE_FOLDER):
         shutil.rmtree(DATA_CACHE_FOLDER)
 
+    # Imported here, as joblib is only needed to rebuild the cache
+    from joblib import Parallel, delayed
+
+    # Datasets without dependencies are independent, so they are built in parallel
     Parallel(n_jobs=n_jobs)(
-        delayed(func)(reset_cache=True) for func in funcs + income_funcs
+        delayed(dataset)(reset_cache=True)
+        for dataset in stale_datasets
+        if not dataset.dependencies
     )
+    for dataset in stale_datasets:
+        if dataset.dependencies:
+            dataset(reset_cache=True)
+
+    # Each build records its fingerprint, but datasets built in parallel processes
+    # may overwrite each other's entry
+    with _manifest_lock:
+        manifest = _read_manifest()
+        manifest.update({name: fingerprints[name] for name in stale_names})
+        _write_manifest(manifest)
+
+    return stale_names
@@ -1,9 +1,9 @@
 """Module for processing all datasets."""
 import os
+from typing import Dict
 
 import pandas as pd
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
 
 # Definitions for filepaths to datasets
 DATAPATH = os.path.join(os.path.dirname(__file__), "data")
@@ -83,11 +83,14 @@ def _feature_county_fips(
 
 def _county_coordinates():
     """Return the longitude and latitude coordinates of each county."""
-    df_uscities = load_uscities()
+    # Use the cached (and memoized) cities rather than parsing the raw file again
+    from . import load_uscities as load_cached_uscities
+
+    df_uscities = load_cached_uscities()
     # Group each city by their county and get the center point (long and lat)
     # https://laracasts.com/discuss/channels/laravel/calculating-center-point-using-geo-latitude-and-longitude-values
     county_coordinates = (
-        df_uscities.groupby("county_fips").mean()[["lng", "lat"]].reset_index()
+        df_uscities.groupby("county_fips")[["lng", "lat"]].mean().reset_index()
     )
 
     return county_coordinates
@@ -406,9 +409,15 @@ def load_age_and_gender_data() -> pd.DataFrame:
     return df_demographic[columns_to_keep]
 
 
-def unique_occupations(format: bool = False) -> np.ndarray:
-    """Return all unique occuptions."""
-    df_income = pd.read_csv(INCOME_FILE)
+def unique_occupations(
+    format: bool = False, df_income: pd.DataFrame = None
+) -> np.ndarray:
+    """Return all unique occuptions.
+
+    Pass an already loaded income dataset as `df_income` to avoid reading it again.
+    """
+    if df_income is None:
+        df_income = pd.read_csv(INCOME_FILE)
 
     # Excluded occupations
     excluded = [
@@ -445,23 +454,21 @@ def unique_occupations(format: bool = False) -> np.ndarray:
     return occupations
 
 
-def load_income(occupation_title: str = "All Occupations") -> pd.DataFrame:
-    """Load and process dataset for income.
+def occupation_codes(df_income: pd.DataFrame = None) -> Dict[str, str]:
+    """Return a mapping from each occupation title to its occupation code.
 
-    Processing of income data includes imputing missing income with the average income
-    values of the three nearest counties.
+    Pass an already loaded income dataset as `df_income` to avoid reading it again.
+    """
+    if df_income is None:
+        df_income = pd.read_csv(INCOME_FILE, usecols=["OCC_TITLE", "OCC_CODE"])
 
-    Parameters
-    ----------
-    occupation_title : str, optional
-        The title of the occupation to load the income data for. Default is
-        'All Occupations'.
+    df_occupations = df_income[["OCC_TITLE", "OCC_CODE"]].drop_duplicates("OCC_TITLE")
 
-    Returns
-    -------
-    pd.DataFrame
-        A dataframe with associated income data at the county level.
-    """
+    return dict(zip(df_occupations["OCC_TITLE"], df_occupations["OCC_CODE"]))
+
+
+def _county_mapping() -> pd.DataFrame:
+    """Return the mapping between msa codes (cbsa and necta) and county fips."""
     # Load mapping between cbsa code and county fips
     df_cbsa_to_county_mapping = pd.read_csv(CBSA_TO_COUNTYFIPS_FILE).rename(
         columns={"CBSA Code": "msa_code"}
@@ -482,14 +489,123 @@ def load_income(occupation_title: str = "All Occupations") -> pd.DataFrame:
         county_code_col="FIPS County Code",
     )
 
+    return df_county_mapping
+
+
+def _clean_income(df_income: pd.DataFrame) -> pd.DataFrame:
+    """Convert the `H_MEDIAN` and `A_MEDIAN` income columns to annual floats.
+
+    Rows where neither income is available are dropped, and the annual median income
+    is completed with the hourly median income where it is not available.
+    """
+    # *  = indicates that a wage estimate is not available
+    # **  = indicates that an employment estimate is not available
+    df_income = df_income[
+        ~df_income["H_MEDIAN"].isin(["*", "**"])
+        | ~df_income["A_MEDIAN"].isin(["*", "**"])
+    ].copy()
+    # Process all columns
+    for col in ["H_MEDIAN", "A_MEDIAN"]:
+        df_income[col] = df_income[col].replace("*", np.nan)
+        df_income[col] = df_income[col].replace("**", np.nan)
+
+        # "#  = indicates a wage equal to or greater than $100.00 per hour or
+        # $208,000 per year ",,,,
+        replace_value = "100.00" if col.startswith("H") else "208,000"
+        df_income[col] = df_income[col].astype(str).replace("#", replace_value)
+
+        df_income[col] = df_income[col].str.replace(",", "").astype(float)
+
+    # Convert hourly to annual and coalesce
+    df_income["A_MEDIAN"] = df_income["A_MEDIAN"].combine_first(
+        df_income["H_MEDIAN"] * 40 * 52  # 40hrs per week, 52 weeks per year
+    )
+
+    return df_income
+
+
+def _impute_income(
+    df_income: pd.DataFrame,
+    df_county_coordinates: pd.DataFrame,
+    n_neighbors: int = 3,
+) -> pd.DataFrame:
+    """Impute the income of counties without one from their nearest counties.
+
+    Parameters
+    ----------
+    df_income : pd.DataFrame
+        A dataframe with one row per county with a known income. Has a `county_fips`
+        column and one column per income figure.
+    df_county_coordinates : pd.DataFrame
+        The `county_fips`, `lng` and `lat` of each county, see `_county_coordinates`.
+    n_neighbors : int, optional
+        The number of nearest counties with a known income to average. Default is 3.
+
+    Returns
+    -------
+    pd.DataFrame
+        The known incomes followed by the imputed incomes of every other county.
+    """
+    from sklearn.neighbors import NearestNeighbors
+
+    income_is_known = df_county_coordinates["county_fips"].isin(
+        df_income["county_fips"]
+    )
+    df_coords_income_known = df_county_coordinates.loc[income_is_known]
+    df_coords_income_not_known = df_county_coordinates.loc[~income_is_known]
+
+    # Fit a nearestneighbors model with our known income, so we can look them up
+    neighbors_model = NearestNeighbors(n_neighbors=n_neighbors, metric="haversine")
+    neighbors_model.fit(df_coords_income_known[["lat", "lng"]])
+    _, indices = neighbors_model.kneighbors(df_coords_income_not_known[["lat", "lng"]])
+
+    # Gather the incomes of the nearest counties of every unknown county at once, and
+    # average them. Each income is a (n_unknown x n_neighbors) matrix.
+    df_known_incomes = (
+        df_income.set_index("county_fips")
+        .reindex(df_coords_income_known["county_fips"])
+        .reset_index(drop=True)
+    )
+    imputed_incomes = {
+        col: pd.DataFrame(df_known_incomes[col].to_numpy()[indices]).mean(axis=1)
+        for col in df_known_incomes.columns
+    }
+    df_all_imputed_incomes = pd.DataFrame(imputed_incomes)
+    df_all_imputed_incomes["county_fips"] = (
+        df_coords_income_not_known["county_fips"].astype(int).to_numpy()
+    )
+
+    # Finally, combine the imputed incomes with the actual incomes
+    return pd.concat([df_income, df_all_imputed_incomes])
+
+
+def load_income(occupation_title: str = "All Occupations") -> pd.DataFrame:
+    """Load and process dataset for income.
+
+    Processing of income data includes imputing missing income with the average income
+    values of the three nearest counties.
+
+    Parameters
+    ----------
+    occupation_title : str, optional
+        The title of the occupation to load the income data for. Default is
+        'All Occupations'.
+
+    Returns
+    -------
+    pd.DataFrame
+        A dataframe with associated income data at the county level.
+    """
+    df_county_mapping = _county_mapping()
+
     # Load income dataset and merge country fips
     df_income = pd.read_csv(INCOME_FILE)
 
     # Filter on the occupation title
-    all_occupations = unique_occupations()
+    all_occupations = unique_occupations(df_income=df_income)
 
     if occupation_title not in all_occupations:
-        formatted_occupations = unique_occupations(format=True)
+        formatted_occupations = unique_occupations(format=True, df_income=df_income)
         formatted_help_msg = "\n" + "\n".join(formatted_occupations)
         raise ValueError(
             f"`{occupation_title}` is not a valid occupation. "
@@ -524,35 +640,7 @@ def load_income(occupation_title: str = "All Occupations") -> pd.DataFrame:
         # "A_PCT90",
     ]
 
-    df_income_filtered = df_income_filtered[columns_to_keep]
-
-    # *  = indicates that a wage estimate is not available
-    # **  = indicates that an employment estimate is not available
-    df_income_filtered = df_income_filtered[
-        ~df_income_filtered["H_MEDIAN"].isin(["*", "**"])
-        | ~df_income_filtered["A_MEDIAN"].isin(["*", "**"])
-    ]
-    # Process all columns
-    for col in columns_to_keep:
-        if col != "county_fips":
-            df_income_filtered[col] = df_income_filtered[col].replace("*", np.nan)
-            df_income_filtered[col] = df_income_filtered[col].replace("**", np.nan)
-
-            # "#  = indicates a wage equal to or greater than $100.00 per hour or
-            # $208,000 per year ",,,,
-            replace_value = "100.00" if col.startswith("H") else "208,000"
-            df_income_filtered[col] = (
-                df_income_filtered[col].astype(str).replace("#", replace_value)
-            )
-
-            df_income_filtered[col] = (
-                df_income_filtered[col].str.replace(",", "").astype(float)
-            )
-
-    # Convert hourly to annual and coalesce
-    df_income_filtered["A_MEDIAN"] = df_income_filtered["A_MEDIAN"].combine_first(
-        df_income_filtered["H_MEDIAN"] * 40 * 52  # 40hrs per week, 52 weeks per year
-    )
+    df_income_filtered = _clean_income(df_income_filtered[columns_to_keep])
     df_income_filtered = df_income_filtered[["A_MEDIAN", "county_fips"]]
 
     # Collapse duplicated counties into their mean. This happens b/c the mapping from
@@ -560,43 +648,142 @@ def load_income(occupation_title: str = "All Occupations") -> pd.DataFrame:
     df_income_filtered = df_income_filtered.groupby("county_fips").mean().reset_index()
 
     # Impute missing income with the average of the 3 nearest counties
-    df_county_coordinates = _county_coordinates()
-    income_is_known = df_county_coordinates["county_fips"].isin(
-        df_income_filtered["county_fips"]
+    df_income_combined = _impute_income(
+        df_income=df_income_filtered,
+        df_county_coordinates=_county_coordinates(),
     )
-    df_coords_income_known = df_county_coordinates.loc[income_is_known].reset_index()
-    df_coords_income_not_known = df_county_coordinates.loc[
-        ~income_is_known
-    ].reset_index()
 
-    # Fit a nearestneighbors model with our known income, so we can look them up
-    neighbors_model = NearestNeighbors(n_neighbors=3, metric="haversine")
-    neighbors_model.fit(df_coords_income_known[["lat", "lng"]])
+    return df_income_combined
 
-    # For all unknown incomes, impute a new income
-    _, indices = neighbors_model.kneighbors(df_coords_income_not_known[["lat", "lng"]])
-    all_imputed_incomes = []
-    for i, matching_indices in enumerate(indices):
-        matching_counties = df_coords_income_known.iloc[matching_indices]["county_fips"]
-        imputed_income = (
-            df_income_filtered[
-                df_income_filtered["county_fips"].isin(matching_counties)
-            ]
-            .drop(["county_fips"], axis=1)
-            .mean()
-        ).to_dict()
-
-        imputed_income["county_fips"] = int(
-            df_coords_income_not_known.iloc[i]["county_fips"]
+
+def _impute_income_all_occupations(
+    df_income: pd.DataFrame,
+    df_county_coordinates: pd.DataFrame,
+    n_neighbors: int = 3,
+    n_candidates: int = 64,
+) -> pd.DataFrame:
+    """Impute the income of every occupation from the nearest counties at once.
+
+    A single neighbor index over every county returns the `n_candidates` nearest
+    counties of each county. For each occupation, the income of an unknown county is
+    the average of the first `n_neighbors` of its candidates with a known income. Only
+    counties with too few known candidates fall back to a neighbor search over the
+    counties with a known income, as in `_impute_income`.
+
+    Parameters
+    ----------
+    df_income : pd.DataFrame
+        A (county x occupation) dataframe of incomes indexed by `county_fips`. Unknown
+        incomes are missing.
+    df_county_coordinates : pd.DataFrame
+        The `county_fips`, `lng` and `lat` of each county, see `_county_coordinates`.
+    n_neighbors : int, optional
+        The number of nearest counties with a known income to average. Default is 3.
+    n_candidates : int, optional
+        The number of nearest counties to consider for each county. Default is 64.
+
+    Returns
+    -------
+    pd.DataFrame
+        The (county x occupation) dataframe with the imputed incomes filled in.
+    """
+    from sklearn.neighbors import NearestNeighbors
+
+    coordinates = df_county_coordinates[["lat", "lng"]]
+    county_fips = df_county_coordinates["county_fips"].to_numpy()
+    n_candidates = min(n_candidates, len(coordinates))
+
+    # Fit a single nearestneighbors model with every county
+    neighbors_model = NearestNeighbors(n_neighbors=n_candidates, metric="haversine")
+    neighbors_model.fit(coordinates)
+    _, candidates = neighbors_model.kneighbors(coordinates)
+
+    incomes = df_income.reindex(county_fips).to_numpy(dtype=float)
+    imputed_incomes = incomes.copy()
+    for occupation in range(incomes.shape[1]):
+        income = incomes[:, occupation]
+        is_known = ~np.isnan(income)
+        n_known = min(n_neighbors, int(is_known.sum()))
+        unknown = np.flatnonzero(~is_known)
+        if n_known == 0 or len(unknown) == 0:
+            continue
+
+        # Select the first `n_known` known candidates of each unknown county
+        candidate_is_known = is_known[candidates[unknown]]
+        is_selected = candidate_is_known & (
+            np.cumsum(candidate_is_known, axis=1) <= n_known
         )
+        candidate_incomes = np.where(is_selected, income[candidates[unknown]], 0.0)
+        imputed_incomes[unknown, occupation] = candidate_incomes.sum(axis=1) / n_known
+
+        # Fall back to an exact search for counties with too few known candidates
+        is_unresolved = is_selected.sum(axis=1) < n_known
+        if is_unresolved.any():
+            unresolved = unknown[is_unresolved]
+            known = np.flatnonzero(is_known)
+            fallback_model = NearestNeighbors(n_neighbors=n_known, metric="haversine")
+            fallback_model.fit(coordinates.iloc[known])
+            _, indices = fallback_model.kneighbors(coordinates.iloc[unresolved])
+            imputed_incomes[unresolved, occupation] = income[known[indices]].mean(
+                axis=1
+            )
 
-        all_imputed_incomes.append(imputed_income)
-    df_all_imputed_incomes = pd.DataFrame(all_imputed_incomes)
+    # Combine the imputed incomes with the incomes of counties without coordinates
+    df_imputed_income = pd.DataFrame(
+        imputed_incomes, index=county_fips, columns=df_income.columns
+    )
+    df_imputed_income = df_imputed_income.combine_first(df_income)
+    df_imputed_income.index.name = "county_fips"
 
-    # Finally, combine the imputed incomes with the actual incomes
-    df_income_combined = pd.concat([df_income_filtered, df_all_imputed_incomes])
+    return df_imputed_income
 
-    return df_income_combined
+
+def load_income_all_occupations() -> pd.DataFrame:
+    """Load and process the income of every occupation in a single pass.
+
+    This is equivalent to calling `load_income` for every occupation, but reads and
+    cleans the income dataset once, and imputes every occupation from a single
+    neighbor index.
+
+    Returns
+    -------
+    pd.DataFrame
+        A (county x occupation) dataframe with the annual median income, indexed by
+        `county_fips` and with one column per occupation title.
+    """
+    df_county_mapping = _county_mapping()
+
+    df_income = pd.read_csv(
+        INCOME_FILE,
+        usecols=["AREA", "OCC_TITLE", "OCC_CODE", "H_MEDIAN", "A_MEDIAN"],
+    )
+    all_occupations = unique_occupations(df_income=df_income)
+    df_income = df_income[df_income["OCC_TITLE"].isin(all_occupations)]
+    df_income = df_income.merge(
+        df_county_mapping,
+        left_on="AREA",
+        right_on="msa_code",
+        how="inner",
+    )
+    df_income = _clean_income(
+        df_income[["county_fips", "OCC_TITLE", "H_MEDIAN", "A_MEDIAN"]]
+    )
+
+    # Pivot to a (county x occupation) matrix, collapsing duplicated counties into
+    # their mean. This happens b/c the mapping from msa_code -> county_fips is not
+    # neccessarily 1:1
+    df_income = (
+        df_income.groupby(["county_fips", "OCC_TITLE"])["A_MEDIAN"]
+        .mean()
+        .unstack("OCC_TITLE")
+        .reindex(columns=all_occupations)
+    )
+    df_income.columns.name = None
+
+    return _impute_income_all_occupations(
+        df_income=df_income,
+        df_county_coordinates=_county_coordinates(),
+    )
 
 
 def load_rent() -> pd.DataFrame:
@@ -1,183 +1,1087 @@
 """Contains tools and functions for computing similar cities."""
 # standard
-from typing import Callable, Dict, List
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
 
 # external
+import numpy as np
 import pandas as pd
-from sklearn.preprocessing import StandardScaler, MinMaxScaler
-from sklearn.metrics.pairwise import euclidean_distances, manhattan_distances
 
 # internal
 import data_loader
+import datasets
 
-from sklearn.preprocessing import StandardScaler
-from sklearn.base import BaseEstimator
+# The scikit-learn based estimators, which are imported from `estimators` on first use
+_LAZY_ESTIMATORS = [
+    "TransformerPandasSupportMixin",
+    "StandardScaler",
+    "MinMaxScaler",
+    "SimilarCities",
+]
 
+# The folder the scaled features of each occupation are memory mapped from
+FEATURE_CACHE_FOLDER = os.path.join(datasets.CACHE_FOLDER, "features")
 
-class TransformerPandasSupportMixin:
-    """This is a simple mixin which adds Pandas support to our transformers."""
 
-    @staticmethod
-    def _preprocess(X, y=None):
-        """Apply preprocessing steps."""
-        if isinstance(X, pd.Series):
-            X = X.values.reshape(-1, 1)
-        if isinstance(X, pd.DataFrame):
-            X = X.values
-        if y is not None:
-            if isinstance(y, pd.Series):
-                y = y.values.reshape(-1, 1)
+def __getattr__(name: str):
+    """Import the scikit-learn based estimators lazily, see `estimators`."""
+    if name in _LAZY_ESTIMATORS:
+        import estimators
 
-        return X, y
+        return getattr(estimators, name)
 
-    @staticmethod
-    def _postprocess(x, x_transformed):
-        """Post processing steps to convert back to a pandas objecta¸™dx."""
-        if isinstance(x, pd.Series):
-            return pd.Series(x_transformed[:, 0], x.index)
-        if isinstance(x, pd.DataFrame):
-            return pd.DataFrame(x_transformed, x.index, columns=x.columns)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-        return x_transformed
 
-    def fit(self, X, y=None, sample_weight=None):
-        """Apply preprocessing steps before fitting."""
-        _X, _y = self._preprocess(X, y)
-        return super().fit(_X, _y)
+def get_feature_weights(sliders: List[float]):
+    """Compute feature weights given the slider inputs."""
+
+    return dict(
+        population=sliders[0],  # Population
+        density=sliders[1],  # Population Denisty
+        average_age=sliders[2],  # Age
+        percent_male=sliders[3],  # Sex
+        rent_50_avg=sliders[4],  # Rental Prices
+        home_price_5yr_median=sliders[5],  # House Prices
+        income_surplus=sliders[6],  # Affordability
+        DEMOCRAT=sliders[7],  # Political Party
+        average_winter_temperature=sliders[8],  # Winter Temperature
+        average_spring_temperature=sliders[9],  # Spring Temperature
+        average_summer_temperature=sliders[10],  # Summer Temperature
+        average_fall_temperature=sliders[11],  # Fall Temperature
+        total_precipitation=sliders[12],  # Precipitation
+        total_snowfall=sliders[13],  # Snowfall
+        bachelors_or_higher=sliders[14],  # Education
+    )
 
-    def fit_transform(self, X, y=None, **fit_params):
-        """Apply preprocessing steps before fitting, then apply postprocessing."""
-        _X, _y = self._preprocess(X, y)
-        x_transformed = super().fit_transform(_X, _y, **fit_params)
-        return self._postprocess(X, x_transformed)
 
-    def transform(self, X, copy=None):
-        """Apply preprocessing and postprocessing for transforming."""
-        _X, _ = self._preprocess(X)
-        x_transformed = super().transform(_X)
-        return self._postprocess(X, x_transformed)
+def get_feature_weight_vector(sliders: List[float]) -> np.ndarray:
+    """Return the feature weights as a float32 vector ordered like the features."""
+    return np.asarray(list(get_feature_weights(sliders).values()), dtype=np.float32)
 
 
-class StandardScaler(TransformerPandasSupportMixin, StandardScaler):
-    """Adding pandas support to StandardScaler."""
+def weighted_distances(
+    matrix: np.ndarray,
+    position: int,
+    feature_weights: np.ndarray = None,
+    metric: str = "manhattan",
+    candidates: np.ndarray = None,
+) -> np.ndarray:
+    """Compute the distance between one row of the matrix and every row.
+
+    Parameters
+    ----------
+    matrix : np.ndarray
+        A (n_cities x n_features) matrix of scaled features.
+
+    position : int
+        The row of the matrix to compare every row against.
+
+    feature_weights : np.ndarray, optional
+        A vector of n_features weights applied to the features before the distance is
+        computed. Default is to weight every feature equally.
+
+    metric : str, optional
+        Either 'manhattan' (L1) or 'euclidean' (L2). Default is 'manhattan'.
+
+    candidates : np.ndarray, optional
+        The rows to compute the distance for. Default is every row of the matrix.
+
+    Returns
+    -------
+    np.ndarray
+        A 1-D array with the distance of each (candidate) row to the selected row.
+    """
+    rows = matrix if candidates is None else matrix[candidates]
+    differences = rows - matrix[position]
+    if feature_weights is not None:
+        differences *= feature_weights
+
+    if metric == "manhattan":
+        return np.abs(differences, out=differences).sum(axis=1)
+    if metric == "euclidean":
+        return np.sqrt(np.einsum("ij,ij->i", differences, differences))
+
+    raise ValueError(
+        f"`{metric}` is not a valid metric. Please select 'manhattan' or 'euclidean'."
+    )
+
+
+def batch_weighted_distances(
+    matrix: np.ndarray,
+    positions: np.ndarray,
+    feature_weights: np.ndarray = None,
+    metric: str = "manhattan",
+    candidates: np.ndarray = None,
+) -> np.ndarray:
+    """Compute the distance between several rows of the matrix and every row.
+
+    Parameters
+    ----------
+    matrix : np.ndarray
+        A (n_cities x n_features) matrix of scaled features.
 
+    positions : np.ndarray
+        The rows of the matrix to compare every row against.
 
-class MinMaxScaler(TransformerPandasSupportMixin, MinMaxScaler):
-    """Adding pandas support to MinMaxScaler."""
+    feature_weights : np.ndarray, optional
+        Either a vector of n_features weights shared by every query, or a
+        (n_queries x n_features) matrix with the weights of each query. Default is to
+        weight every feature equally.
 
+    metric : str, optional
+        Either 'manhattan' (L1) or 'euclidean' (L2). Default is 'manhattan'.
+
+    candidates : np.ndarray, optional
+        The rows to compute the distance for. Default is every row of the matrix.
+
+    Returns
+    -------
+    np.ndarray
+        A (n_queries x n_candidates) array with the distance of each (candidate) row to
+        each selected row.
+    """
+    if metric not in ("manhattan", "euclidean"):
+        raise ValueError(
+            f"`{metric}` is not a valid metric. "
+            + "Please select 'manhattan' or 'euclidean'."
+        )
+
+    rows = matrix if candidates is None else matrix[candidates]
+    queries = matrix[positions]
+    n_queries, n_features = queries.shape
+    if feature_weights is None:
+        feature_weights = np.ones(n_features, dtype=matrix.dtype)
+    feature_weights = np.broadcast_to(
+        np.asarray(feature_weights, dtype=matrix.dtype), (n_queries, n_features)
+    )
+
+    # Accumulate one feature at a time, so memory stays at n_queries x n_candidates
+    distances = np.zeros((n_queries, len(rows)), dtype=matrix.dtype)
+    for feature in range(n_features):
+        differences = rows[:, feature] - queries[:, feature, np.newaxis]
+        differences *= feature_weights[:, feature, np.newaxis]
+        if metric == "manhattan":
+            distances += np.abs(differences, out=differences)
+        else:
+            distances += np.square(differences, out=differences)
+
+    if metric == "euclidean":
+        np.sqrt(distances, out=distances)
+
+    return distances
+
+
+def smallest_positions(distances: np.ndarray, limit: int = None) -> np.ndarray:
+    """Return the positions of the smallest distances in ascending order.
+
+    When a limit is given only the `limit` smallest distances are selected, using a
+    partial selection rather than sorting every distance.
+    """
+    if limit is None or limit >= len(distances):
+        return np.argsort(distances)
+    if limit <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    positions = np.argpartition(distances, limit - 1)[:limit]
+    return positions[np.argsort(distances[positions])]
+
+
+class DistancePool:
+    """Computes distances over chunks of the candidate rows in a pool of threads.
+
+    NumPy releases the GIL in its array operations, so the chunks of a large
+    candidate matrix are computed on several cores at once. With a single worker,
+    distances are computed in the calling thread. Batches are still computed chunk by
+    chunk then, as the distances of a chunk stay in the CPU cache while they are
+    accumulated one feature at a time.
+    """
+
+    def __init__(self, n_workers: int = 1, chunk_rows: int = 8192):
+        """Initialize the DistancePool object.
+
+        Parameters
+        ----------
+        n_workers : int, optional
+            The number of threads computing distances. Default is 1.
+
+        chunk_rows : int, optional
+            The number of candidate rows in a chunk. Default is 8192.
+        """
+        self.n_workers = n_workers
+        self.chunk_rows = chunk_rows
+        self._executor = (
+            ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="distances")
+            if n_workers > 1
+            else None
+        )
+
+    def _map_chunks(
+        self, func: Callable, n_rows: int, candidates: np.ndarray
+    ) -> List[np.ndarray]:
+        """Call `func` with each chunk of the candidates in the pool, in order."""
+        if candidates is None:
+            candidates = np.arange(n_rows)
+        n_chunks = -(-len(candidates) // self.chunk_rows)
+        chunks = np.array_split(candidates, n_chunks)
+        map_chunks = map if self._executor is None else self._executor.map
+        return list(map_chunks(lambda chunk: func(candidates=chunk), chunks))
+
+    def map_rows(self, func: Callable[[slice], None], n_rows: int):
+        """Call `func` with consecutive slices of `chunk_rows` rows, in the pool."""
+        chunks = [
+            slice(start, start + self.chunk_rows)
+            for start in range(0, n_rows, self.chunk_rows)
+        ]
+        if self._executor is None or len(chunks) <= 1:
+            for chunk in chunks:
+                func(chunk)
+        else:
+            list(self._executor.map(func, chunks))
+
+    def batch_weighted_distances(
+        self,
+        matrix: np.ndarray,
+        positions: np.ndarray,
+        feature_weights: np.ndarray = None,
+        metric: str = "manhattan",
+        candidates: np.ndarray = None,
+    ) -> np.ndarray:
+        """Compute `batch_weighted_distances` in parallel, see its documentation."""
+        n_candidates = len(matrix) if candidates is None else len(candidates)
+        if n_candidates <= self.chunk_rows:
+            return batch_weighted_distances(
+                matrix, positions, feature_weights, metric, candidates
+            )
+
+        def _chunk_distances(candidates: np.ndarray) -> np.ndarray:
+            return batch_weighted_distances(
+                matrix, positions, feature_weights, metric, candidates
+            )
+
+        return np.concatenate(
+            self._map_chunks(_chunk_distances, len(matrix), candidates), axis=1
+        )
+
+
+class FeatureIndex:
+    """A kd-tree like partition of the scaled features into leaves of nearby cities.
+
+    Rows are split recursively at the median of their widest feature until a leaf
+    holds at most `leaf_size` rows, and the bounding box of every leaf is kept. For
+    any feature weights, the weighted distance from a query to the bounding box of a
+    leaf is a lower bound of its distance to every city in the leaf. Leaves are
+    therefore visited nearest first, and the search stops once no remaining leaf can
+    hold a city closer than the k nearest found so far.
+
+    The search returns the same k nearest cities as a brute force scan. Distances are
+    equal up to float32 rounding, so only cities tied with the k-th nearest (within a
+    relative tolerance of about 1e-6) may be swapped.
+    """
 
-class SimilarCities:
-    """A class to predict similar cities."""
+    def __init__(self, matrix: np.ndarray, leaf_size: int = 64):
+        """Initialize the FeatureIndex object.
+
+        Parameters
+        ----------
+        matrix : np.ndarray
+            A (n_cities x n_features) matrix of scaled features.
+
+        leaf_size : int, optional
+            The largest number of rows in a leaf. Default is 64.
+        """
+        self.leaf_size = leaf_size
+
+        leaves = []
+        stack = [np.arange(len(matrix))]
+        while stack:
+            rows = stack.pop()
+            if len(rows) <= leaf_size:
+                leaves.append(rows)
+                continue
+
+            values = matrix[rows]
+            feature = np.argmax(values.max(axis=0) - values.min(axis=0))
+            half = len(rows) // 2
+            split = np.argpartition(values[:, feature], half)
+            stack += [rows[split[half:]], rows[split[:half]]]
+
+        # Store the rows of each leaf next to each other, so a leaf is a single slice
+        self.order = np.concatenate(leaves)
+        self.matrix = np.ascontiguousarray(matrix[self.order])
+        self.leaf_starts = np.cumsum([0] + [len(leaf) for leaf in leaves])
+        self.lower = np.minimum.reduceat(self.matrix, self.leaf_starts[:-1], axis=0)
+        self.upper = np.maximum.reduceat(self.matrix, self.leaf_starts[:-1], axis=0)
+
+    def query(
+        self,
+        query: np.ndarray,
+        limit: int,
+        feature_weights: np.ndarray = None,
+        metric: str = "manhattan",
+        leaves_per_step: int = 8,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the rows of the nearest cities to the query, and their distances.
+
+        Parameters
+        ----------
+        query : np.ndarray
+            A vector of n_features scaled features.
+
+        limit : int
+            The number of nearest cities to return.
+
+        feature_weights : np.ndarray, optional
+            A vector of n_features weights applied to the features before the distance
+            is computed. Default is to weight every feature equally.
+
+        metric : str, optional
+            Either 'manhattan' (L1) or 'euclidean' (L2). Default is 'manhattan'.
+
+        leaves_per_step : int, optional
+            The number of leaves whose distances are computed at once. Default is 8.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            The rows of the original matrix of the nearest cities, nearest first, and
+            the distance of each.
+        """
+        if metric not in ("manhattan", "euclidean"):
+            raise ValueError(
+                f"`{metric}` is not a valid metric. "
+                + "Please select 'manhattan' or 'euclidean'."
+            )
+
+        if limit <= 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=self.matrix.dtype)
+
+        query = np.asarray(query, dtype=self.matrix.dtype)
+        if feature_weights is None:
+            feature_weights = np.ones(len(query), dtype=self.matrix.dtype)
+        feature_weights = np.abs(np.asarray(feature_weights, dtype=self.matrix.dtype))
+
+        # The weighted distance from the query to the bounding box of each leaf
+        gaps = np.maximum(self.lower - query, 0) + np.maximum(query - self.upper, 0)
+        gaps *= feature_weights
+        if metric == "manhattan":
+            bounds = gaps.sum(axis=1)
+        else:
+            bounds = np.sqrt(np.einsum("ij,ij->i", gaps, gaps))
+
+        leaf_order = np.argsort(bounds)
+        best_rows = np.empty(0, dtype=np.intp)
+        best_distances = np.empty(0, dtype=self.matrix.dtype)
+        for step in range(0, len(leaf_order), leaves_per_step):
+            leaves = leaf_order[step : step + leaves_per_step]
+            if len(best_rows) == limit and bounds[leaves[0]] > best_distances[-1]:
+                break
+
+            rows = np.concatenate(
+                [
+                    np.arange(self.leaf_starts[leaf], self.leaf_starts[leaf + 1])
+                    for leaf in leaves
+                ]
+            )
+            differences = self.matrix[rows] - query
+            differences *= feature_weights
+            if metric == "manhattan":
+                distances = np.abs(differences, out=differences).sum(axis=1)
+            else:
+                distances = np.sqrt(np.einsum("ij,ij->i", differences, differences))
+
+            rows = np.concatenate([best_rows, rows])
+            distances = np.concatenate([best_distances, distances])
+            positions = smallest_positions(distances, limit=limit)
+            best_rows, best_distances = rows[positions], distances[positions]
+
+        return self.order[best_rows], best_distances
+
+
+class ScaledFeatures:
+    """The scaled features of every city, stored as a contiguous float32 matrix."""
 
     def __init__(
         self,
-        similarity_func: Callable = euclidean_distances,
-        scaler: BaseEstimator = StandardScaler,
-        feature_weights: Dict[str, float] = None,
+        city_ids: np.ndarray,
+        matrix: np.ndarray,
+        feature_names: List[str],
     ):
-        """Initialize the SimilarCities object.
+        """Initialize the ScaledFeatures object.
 
         Parameters
         ----------
-        similarity_func : Callable
-            A callable which accepts X and Y. Returns a similarity matrix.
+        city_ids : np.ndarray
+            The city id of each row in the matrix.
 
-        scaler : BaseEstimator
-            A scaler which describes how to normalize the dataset.
+        matrix : np.ndarray
+            A (n_cities x n_features) float32 matrix of scaled features. The columns
+            are ordered like `feature_names`.
 
-        feature_weights : Dict[str, float], optional
-            A dictionary which maps a feature to its corresponding weight. Default is to include
-            all numerical values.
+        feature_names : List[str]
+            The name of each column in the matrix.
         """
-        self.similarity_func = similarity_func
-        self.scaler = scaler()
-        self.feature_weights = feature_weights
+        self.city_ids = np.asarray(city_ids, dtype=np.int64)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.feature_names = list(feature_names)
+        self._positions = {
+            city_id: position for position, city_id in enumerate(self.city_ids.tolist())
+        }
+        self._index = None
 
-    def get_features(self, data: pd.DataFrame):
-        """Return the subset of features that will be used in the similar city metric."""
+    def position(self, city_id: int) -> int:
+        """Return the row of the matrix that corresponds to the city id."""
+        return self._positions[city_id]
 
-        if self.feature_weights is None:
-            feature_names = data.select_dtypes("number").columns
-        else:
-            feature_names = list(self.feature_weights.keys())
+    def positions(self, city_ids: List[int]) -> np.ndarray:
+        """Return the rows of the matrix that correspond to each city id."""
+        return np.fromiter(
+            (self._positions[city_id] for city_id in city_ids),
+            dtype=np.intp,
+            count=len(city_ids),
+        )
 
-        df_features = data[feature_names]
+    @property
+    def index(self) -> FeatureIndex:
+        """The FeatureIndex of the matrix, built on first use."""
+        if self._index is None:
+            self._index = FeatureIndex(self.matrix)
 
-        # Drop id column if it exists
-        if "id" in df_features:
-            df_features = df_features.drop(["id"], axis=1)
+        return self._index
 
-        # Merge id back in and set as the index
-        df_features = df_features.merge(data["id"], left_index=True, right_index=True)
-        df_features = df_features.set_index("id")
 
-        return df_features
+def _save_arrays(filepaths: Tuple[str, ...], arrays: Tuple[np.ndarray, ...]):
+    """Save each array to its .npy file.
 
-    def _apply_feature_weights(self, df_transformed: pd.DataFrame) -> pd.DataFrame:
-        """Apply the feature weights to the transformed dataset."""
-        if self.feature_weights is None:
-            return df_transformed
+    Every file is replaced in one step, so other workers never map a partial file.
+    """
+    for filepath, array in zip(filepaths, arrays):
 
-        # Apply feature weighting
-        for feature_name, feature_weight in self.feature_weights.items():
-            df_transformed[feature_name] *= feature_weight
+        def _write(temporary_filepath: str, array: np.ndarray = array):
+            with open(temporary_filepath, "wb") as file:
+                np.save(file, array)
 
-        return df_transformed
+        datasets.write_atomically(filepath, _write)
 
-    def transform(self, data: pd.DataFrame) -> pd.DataFrame:
-        """Transform features."""
-        df_features = self.get_features(data=data)
-        df_transformed = self.scaler.transform(df_features)
-        df_transformed = self._apply_feature_weights(df_transformed=df_transformed)
 
-        return df_transformed
+class FeatureStore:
+    """A process-resident store of the prepared features for each occupation.
 
-    def fit_transform(self, data: pd.DataFrame) -> pd.DataFrame:
-        """Transform features."""
-        df_features = self.get_features(data=data)
-        df_transformed = self.scaler.fit_transform(df_features)
-        df_transformed = self._apply_feature_weights(df_transformed=df_transformed)
+    Loading and merging every dataset is far more expensive than computing the
+    distances themselves, so the merged and scaled features are built once per
+    occupation and kept in memory for the lifetime of the process.
 
-        return df_transformed
+    The scaled features are also saved to the feature cache as .npy files, which are
+    memory mapped read-only. Every worker process of the service then shares a single
+    copy of each matrix through the page cache, rather than building its own.
+    """
 
-    def fit(self, data: pd.DataFrame):
-        """Fit the scaler."""
-        df_features = self.get_features(data=data)
-        self.scaler.fit(df_features)
-        return self
+    def __init__(self, cache_folder: str = FEATURE_CACHE_FOLDER):
+        """Initialize the FeatureStore object.
 
-    def predict(self, data: pd.DataFrame, city_id: int):
-        """Return the list of similar cities."""
-        df_transformed = self.transform(data=data)
-        df_compare = df_transformed.loc[city_id].to_frame().T
-        _result = self.similarity_func(X=df_transformed, Y=df_compare)[:, 0]
-        result = pd.Series(
-            _result, index=data["id"], name="similarity_score"
-        ).sort_values()
+        Parameters
+        ----------
+        cache_folder : str, optional
+            The folder to save the scaled features of each occupation to.
+        """
+        self.cache_folder = cache_folder
+        self.feature_names = list(get_feature_weights([1.0] * 15).keys())
+        self._features: Dict[str, ScaledFeatures] = {}
+        self._lock = threading.Lock()
+        self._build_locks: Dict[str, threading.Lock] = {}
 
-        return result
+    def _build(self, occupation_title: str) -> ScaledFeatures:
+        """Load, merge and scale the features for an occupation."""
+        from estimators import MinMaxScaler, SimilarCities
 
+        df_input = data_loader.load_input_data(
+            occupation_title=occupation_title, use_cache=True
+        )
+        # NOTE: The saved features are not rebuilt when the scaler changes, so delete
+        # the feature cache after updating it here
+        estimator = SimilarCities(
+            scaler=MinMaxScaler,
+            feature_weights=dict.fromkeys(self.feature_names, 1.0),
+        )
+        df_features = estimator.get_features(df_input)
+        df_transformed = estimator.scaler.fit_transform(df_features)
 
-def get_feature_weights(sliders: List[float]):
-    """Compute feature weights given the slider inputs."""
+        return ScaledFeatures(
+            city_ids=df_transformed.index.to_numpy(),
+            matrix=df_transformed.to_numpy(dtype=np.float32),
+            feature_names=self.feature_names,
+        )
 
-    return dict(
-        population=sliders[0],  # Population
-        density=sliders[1],  # Population Denisty
-        average_age=sliders[2],  # Age
-        percent_male=sliders[3],  # Sex
-        rent_50_avg=sliders[4],  # Rental Prices
-        home_price_5yr_median=sliders[5],  # House Prices
-        income_surplus=sliders[6],  # Affordability
-        DEMOCRAT=sliders[7],  # Political Party
-        average_winter_temperature=sliders[8],  # Winter Temperature
-        average_spring_temperature=sliders[9],  # Spring Temperature
-        average_summer_temperature=sliders[10],  # Summer Temperature
-        average_fall_temperature=sliders[11],  # Fall Temperature
-        total_precipitation=sliders[12],  # Precipitation
-        total_snowfall=sliders[13],  # Snowfall
-        bachelors_or_higher=sliders[14],  # Education
+    def _cache_filepaths(self, occupation_title: str) -> Tuple[str, str]:
+        """Return the filepaths of the city ids and matrix saved for an occupation."""
+        occupation_title = "".join(
+            char if char.isalnum() else "_" for char in occupation_title
+        ).lower()
+        filepath = os.path.join(self.cache_folder, occupation_title)
+        return filepath + "__city_ids.npy", filepath + "__matrix.npy"
+
+    def _is_cached(self, filepaths: Tuple[str, str]) -> bool:
+        """Return whether the features were saved after their inputs last changed.
+
+        The inputs are the cached base input and income datasets. Features are not
+        cached while either dataset is stale, see `datasets.CachedData._is_stale`.
+        """
+        try:
+            cache_mtime = min(os.stat(filepath).st_mtime_ns for filepath in filepaths)
+        except FileNotFoundError:
+            return False
+
+        for dataset in (datasets.load_base_input_data, datasets.load_income):
+            input_filepath = dataset._datacache_filepath(args=(), kws={})
+            if not os.path.exists(input_filepath) or dataset._is_stale(input_filepath):
+                return False
+            if os.stat(input_filepath).st_mtime_ns > cache_mtime:
+                return False
+
+        return True
+
+    def _save(self, features: ScaledFeatures, filepaths: Tuple[str, str]):
+        """Save the city ids and matrix of the features to the feature cache."""
+        os.makedirs(self.cache_folder, exist_ok=True)
+        _save_arrays(filepaths, (features.city_ids, features.matrix))
+
+    def _load(self, occupation_title: str) -> ScaledFeatures:
+        """Memory map the saved features of an occupation, building them if needed."""
+        filepaths = self._cache_filepaths(occupation_title)
+        if not self._is_cached(filepaths):
+            self._save(self._build(occupation_title), filepaths)
+
+        city_ids_filepath, matrix_filepath = filepaths
+        return ScaledFeatures(
+            city_ids=np.load(city_ids_filepath),
+            matrix=np.load(matrix_filepath, mmap_mode="r"),
+            feature_names=self.feature_names,
+        )
+
+    def get(self, occupation_title: str = "All Occupations") -> ScaledFeatures:
+        """Return the scaled features for an occupation.
+
+        The features are loaded on first use and reused on every later call. Threads
+        asking for the same occupation at once wait for a single load.
+        """
+        features = self._features.get(occupation_title)
+        if features is not None:
+            return features
+
+        with self._lock:
+            build_lock = self._build_locks.setdefault(
+                occupation_title, threading.Lock()
+            )
+        with build_lock:
+            if occupation_title not in self._features:
+                self._features[occupation_title] = self._load(occupation_title)
+
+        return self._features[occupation_title]
+
+
+class TopSimilarCities:
+    """The precomputed most similar cities of every city, for the default sliders.
+
+    Most sessions start from the default sliders, which weight every feature equally.
+    The `top_n` most similar cities of every city are computed once for an occupation
+    and saved next to its features, so requests with the default sliders are answered
+    by looking up a single row rather than computing any distance.
+
+    They are built by `load`, which the warm up of the service calls once the dataset
+    cache is rebuilt, rather than by `datasets.reset_cache`.
+    """
+
+    def __init__(
+        self,
+        feature_store: FeatureStore,
+        occupation_title: str = "All Occupations",
+        top_n: int = 100,
+        chunk_size: int = 8,
+    ):
+        """Initialize the TopSimilarCities object.
+
+        Parameters
+        ----------
+        feature_store : FeatureStore
+            The store of the features the similar cities are computed from.
+
+        occupation_title : str, optional
+            The occupation to compute the similar cities for. Default is
+            "All Occupations".
+
+        top_n : int, optional
+            The number of similar cities to keep for each city. Default is 100.
+
+        chunk_size : int, optional
+            The number of cities whose distances are computed at once when building.
+            Memory use is about 2 x chunk_size x n_cities x 4 bytes. Default is 8,
+            see the `top_similar_cities` benchmark to tune it.
+        """
+        self.feature_store = feature_store
+        self.occupation_title = occupation_title
+        self.top_n = top_n
+        self.chunk_size = chunk_size
+        # The features, neighbors and distances, swapped in together once loaded
+        self._table: Tuple[ScaledFeatures, np.ndarray, np.ndarray] = None
+        self._build_lock = threading.Lock()
+
+    def _cache_filepaths(self) -> Tuple[str, str]:
+        """Return the filepaths of the saved neighbors and distances."""
+        city_ids_filepath, _ = self.feature_store._cache_filepaths(
+            self.occupation_title
+        )
+        filepath = city_ids_filepath[: -len("__city_ids.npy")] + f"__top_{self.top_n}"
+        return filepath + "_neighbors.npy", filepath + "_distances.npy"
+
+    def _is_cached(self, filepaths: Tuple[str, str]) -> bool:
+        """Return whether the similar cities were saved after the features."""
+        try:
+            cache_mtime = min(os.stat(filepath).st_mtime_ns for filepath in filepaths)
+            features_mtime = max(
+                os.stat(filepath).st_mtime_ns
+                for filepath in self.feature_store._cache_filepaths(
+                    self.occupation_title
+                )
+            )
+        except FileNotFoundError:
+            return False
+
+        return cache_mtime >= features_mtime
+
+    def compute(self, features: ScaledFeatures) -> Tuple[np.ndarray, np.ndarray]:
+        """Compute the rows and distances of the most similar cities of every city.
+
+        The distances are computed for `chunk_size` cities at a time into reused
+        buffers, so memory stays bounded however many cities there are. Small chunks
+        keep the buffers in the CPU cache, which is faster than larger chunks.
+        """
+        n_cities, n_features = features.matrix.shape
+        top_n = min(self.top_n, n_cities)
+        neighbors = np.empty((n_cities, top_n), dtype=np.int32)
+        distances = np.empty((n_cities, top_n), dtype=np.float32)
+
+        # One contiguous row per feature, and buffers for a chunk of cities
+        columns = np.ascontiguousarray(features.matrix.T, dtype=np.float32)
+        chunk_distances = np.empty((self.chunk_size, n_cities), dtype=np.float32)
+        differences = np.empty((self.chunk_size, n_cities), dtype=np.float32)
+
+        for start in range(0, n_cities, self.chunk_size):
+            queries = columns[:, start : start + self.chunk_size]
+            n_queries = queries.shape[1]
+            chunk_distances[:n_queries] = 0
+            # The default sliders weight every feature by one
+            for feature in range(n_features):
+                np.subtract(
+                    columns[feature],
+                    queries[feature, :, np.newaxis],
+                    out=differences[:n_queries],
+                )
+                np.abs(differences[:n_queries], out=differences[:n_queries])
+                chunk_distances[:n_queries] += differences[:n_queries]
+
+            top = np.argpartition(chunk_distances[:n_queries], top_n - 1, axis=1)
+            top = top[:, :top_n]
+            top_distances = np.take_along_axis(chunk_distances[:n_queries], top, axis=1)
+            order = np.argsort(top_distances, axis=1)
+            rows = slice(start, start + n_queries)
+            neighbors[rows] = np.take_along_axis(top, order, axis=1)
+            distances[rows] = np.take_along_axis(top_distances, order, axis=1)
+
+        return neighbors, distances
+
+    def load(self, build: bool = True) -> bool:
+        """Memory map the saved similar cities of the current features.
+
+        Parameters
+        ----------
+        build : bool, optional
+            Whether to compute and save the similar cities when they are missing or
+            older than the features. Default is True.
+
+        Returns
+        -------
+        bool
+            Whether the similar cities are loaded.
+        """
+        features = self.feature_store.get(self.occupation_title)
+        table = self._table
+        if table is not None and table[0] is features:
+            return True
+
+        filepaths = self._cache_filepaths()
+        if not self._is_cached(filepaths):
+            if not build:
+                return False
+            # Only builds wait for each other, lookups meanwhile return None
+            with self._build_lock:
+                if not self._is_cached(filepaths):
+                    _save_arrays(filepaths, self.compute(features))
+
+        neighbors_filepath, distances_filepath = filepaths
+        self._table = (
+            features,
+            np.load(neighbors_filepath, mmap_mode="r"),
+            np.load(distances_filepath, mmap_mode="r"),
+        )
+
+        return True
+
+    def lookup(
+        self,
+        city_id: int,
+        occupation_title: str,
+        sliders: List[float],
+        limit: int,
+    ) -> Optional[pd.Series]:
+        """Return the `limit` most similar cities, or None if they are not precomputed.
+
+        Only requests for the occupation, with default sliders and a limit of at most
+        `top_n` are precomputed. The similar cities are loaded on first use, but only
+        built by `load`.
+        """
+        if (
+            occupation_title != self.occupation_title
+            or limit is None
+            or not 0 < limit <= self.top_n
+            or any(slider != 1.0 for slider in sliders)
+        ):
+            return None
+
+        features = self.feature_store.get(occupation_title)
+        if not self.load(build=False):
+            return None
+        table_features, neighbors, distances = self._table
+        if table_features is not features:
+            return None
+
+        position = features.position(city_id)
+        return pd.Series(
+            distances[position, :limit],
+            index=features.city_ids[neighbors[position, :limit]],
+            name="similarity_score",
+        )
+
+
+class SimilarityCache:
+    """A bounded LRU cache of distances with an optional time to live.
+
+    Entries are keyed by the city id, occupation title and slider values, with the
+    slider values quantized to the slider step. The least recently used entries are
+    evicted once either the number of entries or their total size exceeds its bound.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        max_bytes: int = 64 * 2**20,
+        ttl: float = None,
+        slider_step: float = 0.01,
+    ):
+        """Initialize the SimilarityCache object.
+
+        Parameters
+        ----------
+        max_entries : int, optional
+            The maximum number of cached entries. Default is 256.
+
+        max_bytes : int, optional
+            The maximum total size of the cached distances in bytes. Default is 64MiB.
+
+        ttl : float, optional
+            The number of seconds an entry stays valid. Default is no expiry.
+
+        slider_step : float, optional
+            The step of the sliders, slider values are rounded to a multiple of it.
+            Default is 0.01. Pass None to use the exact slider values.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.slider_step = slider_step
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._n_bytes = 0
+        self._entries: "OrderedDict[tuple, Tuple[float, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, city_id: int, occupation_title: str, sliders: List[float]) -> tuple:
+        """Return the cache key of a request."""
+        if self.slider_step:
+            sliders = [
+                round(round(slider / self.slider_step) * self.slider_step, 10)
+                for slider in sliders
+            ]
+
+        return (int(city_id), occupation_title, tuple(float(s) for s in sliders))
+
+    def _remove(self, key: tuple):
+        """Remove an entry from the cache."""
+        _, distances = self._entries.pop(key)
+        self._n_bytes -= distances.nbytes
+
+    def get(self, key: tuple) -> Optional[np.ndarray]:
+        """Return the cached distances, or None if they are not cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None:
+                if time.monotonic() - entry[0] > self.ttl:
+                    self._remove(key)
+                    entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple, distances: np.ndarray):
+        """Cache the distances, evicting the least recently used entries."""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic(), distances)
+            self._n_bytes += distances.nbytes
+
+            while self._entries and (
+                len(self._entries) > self.max_entries or self._n_bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        """Return the hit/miss counters and the current size of the cache."""
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                entries=len(self._entries),
+                bytes=self._n_bytes,
+                max_entries=self.max_entries,
+                max_bytes=self.max_bytes,
+                ttl=self.ttl,
+            )
+
+
+class AnchorDifferences:
+    """A bounded LRU cache of the absolute feature differences to anchor cities.
+
+    For a fixed anchor city, the weighted manhattan distance of every city is the
+    product of its (n_cities x n_features) matrix of absolute feature differences with
+    the feature weights. Caching that matrix for recently selected cities turns every
+    slider change into a single matrix-vector product. Both the differences and the
+    product are computed in row chunks across the threads of a DistancePool.
+    """
+
+    def __init__(self, max_entries: int = 32, pool: DistancePool = None):
+        """Initialize the AnchorDifferences object.
+
+        Parameters
+        ----------
+        max_entries : int, optional
+            The maximum number of cached anchor cities. Default is 32.
+
+        pool : DistancePool, optional
+            The pool to compute the differences and distances in. Default is to
+            compute them in the calling thread.
+        """
+        self.max_entries = max_entries
+        self.pool = pool or DistancePool()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._n_bytes = 0
+        # Entries keep their features alive, so the id of the features stays unique
+        self._entries: "OrderedDict[tuple, Tuple[ScaledFeatures, np.ndarray]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get(self, features: ScaledFeatures, position: int) -> np.ndarray:
+        """Return the absolute differences of every row to a row of the features."""
+        key = (id(features), int(position))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        matrix = features.matrix
+        differences = np.empty(matrix.shape, dtype=np.float32)
+
+        def _chunk_differences(rows: slice):
+            np.subtract(matrix[rows], matrix[position], out=differences[rows])
+            np.abs(differences[rows], out=differences[rows])
+
+        self.pool.map_rows(_chunk_differences, len(matrix))
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (features, differences)
+                self._n_bytes += differences.nbytes
+            while len(self._entries) > self.max_entries:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._n_bytes -= evicted.nbytes
+                self.evictions += 1
+
+        return differences
+
+    def distances(
+        self, features: ScaledFeatures, position: int, feature_weights: np.ndarray
+    ) -> np.ndarray:
+        """Return the weighted manhattan distance of every row to a row."""
+        feature_weights = np.abs(np.asarray(feature_weights, dtype=np.float32))
+        differences = self.get(features, position)
+        distances = np.empty(len(differences), dtype=np.float32)
+
+        def _chunk_distances(rows: slice):
+            np.matmul(differences[rows], feature_weights, out=distances[rows])
+
+        self.pool.map_rows(_chunk_distances, len(differences))
+        return distances
+
+    def stats(self) -> Dict[str, int]:
+        """Return the hit/miss counters and the memory used by the cache."""
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                entries=len(self._entries),
+                bytes=self._n_bytes,
+                max_entries=self.max_entries,
+            )
+
+
+class SingleFlight:
+    """Coalesce concurrent identical computations into a single computation.
+
+    The first call for a key computes the result in its own thread. Calls for the same
+    key made before that computation finishes wait for it and share its result, rather
+    than computing the same result again.
+    """
+
+    def __init__(self):
+        """Initialize the SingleFlight object."""
+        self.calls = 0
+        self.coalesced = 0
+        self._futures: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, func: Callable, *args, **kws):
+        """Return `func(*args, **kws)`, shared with the identical calls in flight."""
+        with self._lock:
+            self.calls += 1
+            future = self._futures.get(key)
+            if future is not None:
+                self.coalesced += 1
+            else:
+                self._futures[key] = computation = Future()
+
+        if future is not None:
+            return future.result()
+
+        try:
+            result = func(*args, **kws)
+            computation.set_result(result)
+            return result
+        except BaseException as error:
+            computation.set_exception(error)
+            raise
+        finally:
+            # Later calls compute anew, e.g. once the result is cached
+            with self._lock:
+                del self._futures[key]
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of calls, and how many shared a computation in flight."""
+        with self._lock:
+            return dict(
+                calls=self.calls,
+                coalesced=self.coalesced,
+                in_flight=len(self._futures),
+            )
+
+
+# The feature store shared by every request served by this process
+FEATURE_STORE = FeatureStore()
+
+# The precomputed most similar cities for the default sliders and "All Occupations"
+TOP_SIMILAR_CITIES = TopSimilarCities(FEATURE_STORE)
+
+# The distance cache shared by every request served by this process. The bounds can
+# be configured with the CITY_EXPLORER_CACHE_* environment variables.
+SIMILARITY_CACHE = SimilarityCache(
+    max_entries=int(os.environ.get("CITY_EXPLORER_CACHE_ENTRIES", 256)),
+    max_bytes=int(os.environ.get("CITY_EXPLORER_CACHE_BYTES", 64 * 2**20)),
+    ttl=(
+        float(os.environ["CITY_EXPLORER_CACHE_TTL"])
+        if "CITY_EXPLORER_CACHE_TTL" in os.environ
+        else None
+    ),
+    slider_step=float(os.environ.get("CITY_EXPLORER_SLIDER_STEP", 0.01)),
+)
+
+# Computes the distances of large candidate sets and batches in a pool of
+# CITY_EXPLORER_DISTANCE_WORKERS threads
+DISTANCE_POOL = DistancePool(
+    n_workers=int(os.environ.get("CITY_EXPLORER_DISTANCE_WORKERS", 1)),
+)
+
+# The absolute feature differences to the most recently selected cities, of which
+# there are at most CITY_EXPLORER_ANCHOR_ENTRIES
+ANCHOR_DIFFERENCES = AnchorDifferences(
+    max_entries=int(os.environ.get("CITY_EXPLORER_ANCHOR_ENTRIES", 32)),
+    pool=DISTANCE_POOL,
+)
+
+# Coalesces the identical similarity requests in flight, e.g. the burst of requests
+# Tableau sends while a slider is dragged
+SINGLE_FLIGHT = SingleFlight()
+
+
+def _city_distances(
+    city_id: int,
+    occupation_title: str,
+    sliders: List[float],
+) -> Tuple[ScaledFeatures, np.ndarray]:
+    """Return the features and the distance of every city to the selected city.
+
+    Distances are looked up in `SIMILARITY_CACHE` before they are computed.
+    """
+    features = FEATURE_STORE.get(occupation_title)
+    key = SIMILARITY_CACHE.key(city_id, occupation_title, sliders)
+
+    distances = SIMILARITY_CACHE.get(key)
+    if distances is None:
+        distances = SINGLE_FLIGHT.do(key, _compute_city_distances, features, key)
+
+    return features, distances
+
+
+def _compute_city_distances(features: ScaledFeatures, key: tuple) -> np.ndarray:
+    """Compute and cache the distance of every city to the city of a cache key."""
+    city_id, _, sliders = key
+    # NOTE: If you want to update the distance function, overwrite it here. The
+    # manhattan distance is computed from the cached differences to the city.
+    distances = ANCHOR_DIFFERENCES.distances(
+        features=features,
+        position=features.position(city_id),
+        feature_weights=get_feature_weight_vector(sliders),
     )
+    SIMILARITY_CACHE.put(key, distances)
+
+    return distances
 
 
 def predict_similar_cities(
@@ -185,6 +1089,8 @@ def predict_similar_cities(
     occupation_title: str,
     sliders: List[float],
     limit: int = None,
+    candidate_ids: List[int] = None,
+    search: str = "brute",
 ) -> pd.Series:
     """Compute similar cities based on the given criteria.
 
@@ -203,6 +1109,15 @@ def predict_similar_cities(
     limit : int, optional
         The number of similar cities to show. Default is no limit.
 
+    candidate_ids : List[int], optional
+        The ids of the cities to consider. Default is to consider every city.
+
+    search : str, optional
+        Either 'brute', which computes the distance to every city, or 'index', which
+        searches the FeatureIndex of the features for the `limit` most similar cities.
+        The index is only used with a limit and without candidate ids. Default is
+        'brute'.
+
     Returns
     -------
     pd.Series
@@ -223,28 +1138,153 @@ def predict_similar_cities(
         limit=30,
     )
     """
+    if search not in ("brute", "index"):
+        raise ValueError(
+            f"`{search}` is not a valid search. Please select 'brute' or 'index'."
+        )
 
-    # Load data and extract feature weights
-    df_input = data_loader.load_input_data(
-        occupation_title=occupation_title, use_cache=True
-    )
-    feature_weights = get_feature_weights(sliders)
-
-    # Create an estimator which will determine the similar cities and fit the standard
-    # scaler.
-    # NOTE: If you want to update the distance function or scaler, overwrite it here
-    similar_cities_estimator = SimilarCities(
-        similarity_func=manhattan_distances,
-        scaler=MinMaxScaler,
-        feature_weights=feature_weights,
+    if limit is not None and candidate_ids is None:
+        key = SIMILARITY_CACHE.key(city_id, occupation_title, sliders)
+        similar_cities = TOP_SIMILAR_CITIES.lookup(
+            city_id, occupation_title, sliders=key[2], limit=limit
+        )
+        if similar_cities is not None:
+            return similar_cities
+
+    if search == "index" and limit is not None and candidate_ids is None:
+        # The sliders are quantized like the cached distances of the brute search
+        _, _, quantized_sliders = SIMILARITY_CACHE.key(
+            city_id, occupation_title, sliders
+        )
+        features = FEATURE_STORE.get(occupation_title)
+        positions, distances = features.index.query(
+            query=features.matrix[features.position(city_id)],
+            limit=limit,
+            feature_weights=get_feature_weight_vector(quantized_sliders),
+            metric="manhattan",
+        )
+        return pd.Series(
+            distances, index=features.city_ids[positions], name="similarity_score"
+        )
+
+    features, distances = _city_distances(city_id, occupation_title, sliders)
+
+    # Select the most similar cities, applying any limits
+    city_ids = features.city_ids
+    if candidate_ids is not None:
+        candidates = features.positions(candidate_ids)
+        distances = distances[candidates]
+        city_ids = city_ids[candidates]
+    positions = smallest_positions(distances, limit=limit)
+    similar_cities = pd.Series(
+        distances[positions],
+        index=city_ids[positions],
+        name="similarity_score",
     )
-    similar_cities_estimator.fit(df_input)
 
-    # Predict similar cities for a given city_id
-    similar_cities = similar_cities_estimator.predict(data=df_input, city_id=city_id)
+    return similar_cities
+
+
+def rank_similar_cities(
+    city_id: int,
+    occupation_title: str,
+    sliders: List[float],
+    cities: List[int],
+) -> List[int]:
+    """Rank a list of cities by their similarity to the selected city.
+
+    Parameters
+    ----------
+    city_id : int
+        The id of the selected city.
+
+    occupation_title : str
+        The name of the selected occupation.
+
+    sliders : List[float]
+        A list of slider values which correspond the users importances of each feature.
+
+    cities : List[int]
+        The ids of the cities to rank.
+
+    Returns
+    -------
+    List[int]
+        The rank of each city in `cities`, in the same order. The most similar city
+        has rank 1 and tied cities share the lowest rank of the tie.
+    """
+    features, distances = _city_distances(city_id, occupation_title, sliders)
+    distances = distances[features.positions(cities)]
+
+    # The rank of a city is one more than the number of strictly closer cities
+    city_rankings = np.searchsorted(np.sort(distances), distances, side="left") + 1
+
+    return city_rankings.tolist()
+
+
+def predict_similar_cities_batch(
+    city_ids: List[int],
+    occupation_title: str,
+    sliders: List[List[float]],
+    limit: int = None,
+    candidate_ids: List[int] = None,
+) -> List[pd.Series]:
+    """Compute similar cities for several cities at once.
+
+    The distances for every city are computed as a single matrix operation over the
+    resident features, rather than one request per city.
+
+    Parameters
+    ----------
+    city_ids : List[int]
+        The ids of the selected cities.
+
+    occupation_title : str
+        The name of the selected occupation.
 
-    # Apply any limits
-    if limit is not None:
-        similar_cities = similar_cities.iloc[:limit]
+    sliders : List[List[float]]
+        The slider values of each selected city, in the same order as `city_ids`.
+
+    limit : int, optional
+        The number of similar cities to show for each city. Default is no limit.
+
+    candidate_ids : List[int], optional
+        The ids of the cities to consider. Default is to consider every city.
+
+    Returns
+    -------
+    List[pd.Series]
+        One ordered series per selected city, in the same order as `city_ids`. See
+        `predict_similar_cities`.
+    """
+    if len(sliders) != len(city_ids):
+        raise ValueError("Expected one list of slider values for each city id.")
+    if len(city_ids) == 0:
+        return []
+
+    features = FEATURE_STORE.get(occupation_title)
+    candidates = None if candidate_ids is None else features.positions(candidate_ids)
+    distances = DISTANCE_POOL.batch_weighted_distances(
+        matrix=features.matrix,
+        positions=features.positions(city_ids),
+        feature_weights=np.stack([get_feature_weight_vector(s) for s in sliders]),
+        metric="manhattan",
+        candidates=candidates,
+    )
+
+    # Select the most similar cities of each city, applying any limits
+    candidate_city_ids = (
+        features.city_ids if candidates is None else features.city_ids[candidates]
+    )
+    all_similar_cities = []
+    for city_distances in distances:
+        positions = smallest_positions(city_distances, limit=limit)
+        all_similar_cities.append(
+            pd.Series(
+                city_distances[positions],
+                index=candidate_city_ids[positions],
+                name="similarity_score",
+            )
+        )
 
-    return similar_cities.copy()
+    return all_similar_cities
@@ -1,19 +1,61 @@
 """Tabpy functions for Tableau."""
 import os
 import socket
-from typing import Callable, Dict, List
-from flask import Flask, request
+import sys
+import threading
+from typing import Callable, Dict, List, Mapping
+from flask import Flask, abort, jsonify, request
+from werkzeug.serving import WSGIRequestHandler
 
 import platform
 import time
+import numpy as np
+import pyarrow as pa
 from tabpy.tabpy_tools.client import Client
 
+import datasets
 import similar_cities
 
 HOSTNAME = "localhost"
 FLASK_PORT = 5001
 TABPY_PORT = 9004
 
+# Compact binary response format, offered alongside JSON
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+# The name of each slider, in the order expected by `similar_cities`
+SLIDER_NAMES = [
+    "population",
+    "population_denisty",
+    "age",
+    "sex",
+    "rental_prices",
+    "house_prices",
+    "affordability",
+    "political_party",
+    "winter_temperature",
+    "spring_temperature",
+    "summer_temperature",
+    "fall_temperature",
+    "precipitation",
+    "snowfall",
+    "education",
+]
+
+# Occupations whose features are preloaded at startup, besides "All Occupations".
+# Titles contain commas, so they are separated by semicolons.
+WARMUP_OCCUPATIONS = [
+    title.strip()
+    for title in os.environ.get("CITY_EXPLORER_WARMUP_OCCUPATIONS", "").split(";")
+    if title.strip()
+]
+
+# The server run by `python tabpy_loader.py`, either the threaded production server
+# "waitress" or the flask "development" server. See `wsgi.py` to serve the flask
+# application with several worker processes instead.
+SERVER = os.environ.get("CITY_EXPLORER_SERVER", "development")
+SERVER_THREADS = int(os.environ.get("CITY_EXPLORER_SERVER_THREADS", 8))
+
 
 class SimilarCitiesClient(Client):
     def __init__(self, hostname: str = "localhost", port: int = 9004):
@@ -90,17 +132,46 @@ def similar_cities_tabpy(
     precipitation: float,
     snowfall: float,
     education: float,
-) -> Dict[str, float]:
+) -> List[int]:
     """TabPy for similar cities."""
+    import os
+    import pyarrow as pa
     import requests
-    import pandas as pd
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
 
     HOSTNAME = "localhost"
     FLASK_PORT = 5001
+    ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+    # (connect, read) timeouts in seconds and the number of retries per request
+    TIMEOUT = (
+        float(os.environ.get("CITY_EXPLORER_CONNECT_TIMEOUT", 1.0)),
+        float(os.environ.get("CITY_EXPLORER_READ_TIMEOUT", 30.0)),
+    )
+    RETRIES = int(os.environ.get("CITY_EXPLORER_RETRIES", 2))
 
-    response = requests.get(
-        url=f"http://{HOSTNAME}:{FLASK_PORT}/predict_similar_cities/",
-        params=dict(
+    # Tableau calls this function in bursts, so keep a pooled keep-alive session in
+    # the globals of the deployed function rather than opening a connection per call
+    session = globals().get("_similar_cities_session")
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=8,
+            max_retries=Retry(total=RETRIES, backoff_factor=0.1, allowed_methods=None),
+        )
+        session.mount("http://", adapter)
+        globals()["_similar_cities_session"] = session
+
+    # The ranking is done by the flask application, so only the ranks of the visible
+    # cities are sent back. The values are form encoded, since `cities` is too long to
+    # be sent in the url.
+    response = session.post(
+        url=f"http://{HOSTNAME}:{FLASK_PORT}/rank_similar_cities/",
+        data=dict(
+            # Tableau may send the ids as floats, which the endpoint rejects
+            cities=[int(city) for city in cities],
             city_id=city_id,
             occupation_title=occupation_title,
             population=population,
@@ -119,18 +190,17 @@ def similar_cities_tabpy(
             snowfall=snowfall,
             education=education,
         ),
+        headers={"Accept": f"{ARROW_MIMETYPE}, application/json;q=0.5"},
+        timeout=TIMEOUT,
     )
-    # result has the following structure is in this form
-    # {
-    #   city_id (str): similarity_score (float),
-    #   ...: ...
-    # }
-
-    result = response.json()
+    response.raise_for_status()
+    # result is the rank (int) of each city in `cities`, in the same order
 
-    # index = city_id, value = similarity_score
-    filtered_cities = pd.Series(result).loc[cities]
-    city_rankings = filtered_cities.rank(method="min").astype(int).values.tolist()
+    if response.headers.get("Content-Type", "").startswith(ARROW_MIMETYPE):
+        table = pa.ipc.open_stream(response.content).read_all()
+        city_rankings = table.column("rank").to_pylist()
+    else:
+        city_rankings = response.json()
 
     return city_rankings
 
@@ -143,42 +213,314 @@ def start_tabpy():
     client.deploy(func=similar_cities_tabpy)
 
 
+class WarmUp:
+    """Preload the datasets and features served by the flask application.
+
+    Without a warm up, the first request for an occupation pays for rebuilding any
+    stale dataset caches, loading them and scaling the features, which can time out
+    Tableau. Each stage is timed, and a stage that fails does not stop the others.
+    """
+
+    # Without these stages every similarity request fails
+    required_stages = (
+        "dataset_cache",
+        "base_input_data",
+        "income/All Occupations",
+        "features/All Occupations",
+    )
+
+    def __init__(self, occupation_titles: List[str] = ()):
+        """Initialize the WarmUp object.
+
+        Parameters
+        ----------
+        occupation_titles : List[str]
+            The occupations to preload besides "All Occupations".
+        """
+        self.occupation_titles = ["All Occupations"] + [
+            title for title in occupation_titles if title != "All Occupations"
+        ]
+        self.stages: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+        self.done = threading.Event()
+
+    def _stage(self, name: str, func: Callable):
+        """Run and time a single stage of the warm up."""
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception as error:
+            self.errors[name] = repr(error)
+            print(f"Warm up stage {name!r} failed: {error!r}")
+        self.stages[name] = time.perf_counter() - start
+
+    def rebuild_cache(self):
+        """Rebuild the stale dataset caches.
+
+        Run this before serving, so no request rebuilds a dataset the warm up is
+        rebuilding at the same time.
+        """
+        self._stage("dataset_cache", datasets.reset_cache)
+
+    def preload(self):
+        """Load the datasets and features, once the dataset caches are rebuilt."""
+        self._stage("base_input_data", datasets.load_base_input_data)
+        for title in self.occupation_titles:
+            self._stage(
+                f"income/{title}",
+                lambda: datasets.load_income(occupation_title=title),
+            )
+            self._stage(
+                f"features/{title}",
+                lambda: similar_cities.FEATURE_STORE.get(title),
+            )
+        # Builds the similar cities for the default sliders, unless they are saved
+        self._stage("top_similar_cities", similar_cities.TOP_SIMILAR_CITIES.load)
+        self.done.set()
+        print(f"Warm up done in {sum(self.stages.values()):.1f} seconds.")
+
+    def run(self):
+        """Run every stage of the warm up in order."""
+        self.rebuild_cache()
+        self.preload()
+
+    def start(self) -> threading.Thread:
+        """Preload in a background thread, so the service can start serving.
+
+        The dataset caches must be rebuilt beforehand, see `rebuild_cache`.
+        """
+        thread = threading.Thread(target=self.preload, name="warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def status(self) -> Dict:
+        """Return whether the service is ready, and the seconds each stage took.
+
+        The service is ready once the warm up is done and none of the
+        `required_stages` failed.
+        """
+        failed = [name for name in self.required_stages if name in self.errors]
+        return dict(
+            ready=self.done.is_set() and not failed,
+            stages=dict(self.stages),
+            errors=dict(self.errors),
+        )
+
+
+WARM_UP = WarmUp(WARMUP_OCCUPATIONS)
+
 # Deploy a flask application to do the heavy lifting.
 app = Flask(__name__)
 
 
+def _parse_sliders(values: Mapping[str, float]) -> List[float]:
+    """Return the slider values in order. Missing sliders default to 1.0."""
+    return [float(values.get(name, 1.0)) for name in SLIDER_NAMES]
+
+
+def _parse_ids(values: List, name: str) -> List[int]:
+    """Return the values as integer ids. Responds with 400 if any is not an integer."""
+    try:
+        if isinstance(values, (str, Mapping)):
+            raise TypeError(f"Expected a list, got {values!r}")
+        return [int(value) for value in values]
+    except (TypeError, ValueError):
+        abort(400, description=f"`{name}` must be a list of integer ids.")
+
+
+def _accepts_arrow() -> bool:
+    """Return whether the client prefers the binary Arrow format over JSON."""
+    best_match = request.accept_mimetypes.best_match(
+        ["application/json", ARROW_MIMETYPE]
+    )
+    return best_match == ARROW_MIMETYPE
+
+
+def _arrow_response(columns: Dict[str, np.ndarray]):
+    """Return the columns as an Arrow IPC stream response."""
+    table = pa.table(columns)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    response = app.response_class(sink.getvalue().to_pybytes(), mimetype=ARROW_MIMETYPE)
+    response.vary.add("Accept")
+    return response
+
+
+def _prediction_args() -> Dict:
+    """Return the arguments of `predict_similar_cities` given in the url."""
+    return dict(
+        city_id=int(request.args.get("city_id")),
+        occupation_title=str(request.args.get("occupation_title")),
+        sliders=_parse_sliders(request.args),
+        # Optionally only return the top `limit` cities among the candidate cities
+        limit=request.args.get("limit", default=None, type=int),
+        candidate_ids=request.args.getlist("candidate_ids", type=int) or None,
+        # Either "brute" or "index", see `similar_cities.predict_similar_cities`
+        search=request.args.get("search", default="brute"),
+    )
+
+
+def _predictions_response(predictions):
+    """Return the similarity scores as JSON, or as Arrow if the client accepts it."""
+    if _accepts_arrow():
+        return _arrow_response(
+            dict(
+                city_id=predictions.index.to_numpy(dtype=np.int64),
+                similarity_score=predictions.to_numpy(dtype=np.float32),
+            )
+        )
+
+    return predictions.to_json()
+
+
 @app.route("/predict_similar_cities/", methods=["GET"])
 def predict_similar_cities():
-    """End point for predicting similar cities."""
-    city_id = int(request.args.get("city_id"))
-    occupation_title = str(request.args.get("occupation_title"))
-    sliders = [
-        float(request.args.get("population", default=1.0)),
-        float(request.args.get("population_denisty", default=1.0)),
-        float(request.args.get("age", default=1.0)),
-        float(request.args.get("sex", default=1.0)),
-        float(request.args.get("rental_prices", default=1.0)),
-        float(request.args.get("house_prices", default=1.0)),
-        float(request.args.get("affordability", default=1.0)),
-        float(request.args.get("political_party", default=1.0)),
-        float(request.args.get("winter_temperature", default=1.0)),
-        float(request.args.get("spring_temperature", default=1.0)),
-        float(request.args.get("summer_temperature", default=1.0)),
-        float(request.args.get("fall_temperature", default=1.0)),
-        float(request.args.get("precipitation", default=1.0)),
-        float(request.args.get("snowfall", default=1.0)),
-        float(request.args.get("education", default=1.0)),
-    ]
-
-    predictions = similar_cities.predict_similar_cities(
+    """End point for predicting similar cities.
+
+    Returns JSON by default, or an Arrow IPC stream with an int64 `city_id` and a
+    float32 `similarity_score` column if the client accepts `ARROW_MIMETYPE`.
+    """
+    predictions = similar_cities.predict_similar_cities(**_prediction_args())
+    return _predictions_response(predictions)
+
+
+@app.route("/rank_similar_cities/", methods=["GET", "POST"])
+def rank_similar_cities():
+    """End point for ranking a list of cities by their similarity to a city.
+
+    Accepts the same values as `/predict_similar_cities/` plus the repeated `cities`
+    ids, either in the url or form encoded. Returns the rank of each city in `cities`,
+    either as JSON or as an Arrow IPC stream with an int32 `rank` column.
+    """
+    city_id = int(request.values.get("city_id"))
+    occupation_title = str(request.values.get("occupation_title"))
+    sliders = _parse_sliders(request.values)
+    # Every city must be parsed, so the ranks line up with the cities Tableau sent
+    cities = _parse_ids(request.values.getlist("cities"), "cities")
+
+    city_rankings = similar_cities.rank_similar_cities(
         city_id=city_id,
         occupation_title=occupation_title,
         sliders=sliders,
+        cities=cities,
     )
 
-    return predictions.to_json()
+    if _accepts_arrow():
+        return _arrow_response(dict(rank=np.asarray(city_rankings, dtype=np.int32)))
+
+    return jsonify(city_rankings)
+
+
+@app.route("/cache_stats/", methods=["GET"])
+def cache_stats():
+    """End point for the counters and memory used by the similarity caches."""
+    return jsonify(
+        **similar_cities.SIMILARITY_CACHE.stats(),
+        anchor_differences=similar_cities.ANCHOR_DIFFERENCES.stats(),
+        single_flight=similar_cities.SINGLE_FLIGHT.stats(),
+    )
+
+
+@app.route("/ready/", methods=["GET"])
+def ready():
+    """End point for the readiness of the service.
+
+    Responds with 503 until the warm up is done, or when a stage every request needs
+    failed, and reports how long each stage of the warm up took.
+    """
+    status = WARM_UP.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+@app.route("/predict_similar_cities/batch", methods=["POST"])
+def predict_similar_cities_batch():
+    """End point for predicting similar cities for several cities at once.
+
+    Expects a JSON body with `city_ids` and `occupation_title`, and optionally
+    `sliders`, `limit` and `candidate_ids`. `sliders` is either a single mapping of
+    slider names to values shared by every city, or a list with one mapping per city.
+    Returns a list with the similarity scores of each city, in the order of `city_ids`.
+    """
+    body = request.get_json(silent=True)
+    required_keys = ("city_ids", "occupation_title")
+    if not isinstance(body, Mapping) or any(key not in body for key in required_keys):
+        abort(400, description="Expected `city_ids` and `occupation_title` as JSON.")
+
+    city_ids = _parse_ids(body["city_ids"], "city_ids")
+    occupation_title = str(body["occupation_title"])
+
+    sliders = body.get("sliders", {})
+    if isinstance(sliders, Mapping):
+        sliders = [sliders] * len(city_ids)
+    try:
+        if len(sliders) != len(city_ids):
+            raise ValueError("Expected one mapping of sliders for each city id.")
+        sliders = [_parse_sliders(values) for values in sliders]
+    except (AttributeError, TypeError, ValueError):
+        abort(400, description="`sliders` must map slider names to numbers.")
+
+    candidate_ids = body.get("candidate_ids")
+    if candidate_ids is not None:
+        candidate_ids = _parse_ids(candidate_ids, "candidate_ids")
+
+    limit = body.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            abort(400, description="`limit` must be an integer.")
+
+    all_predictions = similar_cities.predict_similar_cities_batch(
+        city_ids=city_ids,
+        occupation_title=occupation_title,
+        sliders=sliders,
+        limit=limit,
+        candidate_ids=candidate_ids,
+    )
+
+    return app.response_class(
+        "[" + ",".join(predictions.to_json() for predictions in all_predictions) + "]",
+        mimetype="application/json",
+    )
+
+
+def serve(server: str = SERVER, threads: int = SERVER_THREADS):
+    """Serve the flask application until interrupted.
+
+    Parameters
+    ----------
+    server : str, optional
+        Either "waitress", a production server handling requests with a pool of
+        threads, or "development", the flask development server.
+
+    threads : int, optional
+        The number of threads handling requests with the waitress server.
+    """
+    if server == "waitress":
+        from waitress import serve as waitress_serve
+
+        waitress_serve(app, host=HOSTNAME, port=FLASK_PORT, threads=threads)
+    elif server == "development":
+        # HTTP/1.1 lets the TabPy session keep its connections alive between calls
+        WSGIRequestHandler.protocol_version = "HTTP/1.1"
+        app.run(host=HOSTNAME, port=FLASK_PORT, threaded=True)
+    else:
+        raise ValueError(
+            f"`{server}` is not a valid server. Please select 'waitress' or "
+            + "'development'."
+        )
 
 
 if __name__ == "__main__":
+    # Pickled from `__main__`, so the deployed function does not import this module
     start_tabpy()
-    app.run(host=HOSTNAME, port=FLASK_PORT)
+    if "--deploy-only" in sys.argv[1:]:
+        sys.exit()
+
+    # Rebuild the data before serving, then preload the data and features up front
+    # so early requests do not pay for it
+    WARM_UP.rebuild_cache()
+    WARM_UP.start()
+    serve()
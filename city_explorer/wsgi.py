@@ -0,0 +1,19 @@
+"""WSGI entry point to serve the flask application with several worker processes.
+
+For example, on Linux or macOS, run from the `city_explorer` folder:
+
+    gunicorn --workers 4 --threads 4 --preload --bind localhost:5001 wsgi:app
+
+With `--preload` the warm up runs once, before the workers are forked. The scaled
+features are memory mapped from the feature cache, so every worker shares a single
+read-only copy of them instead of loading its own.
+
+This does not deploy the TabPy function. Deploy it once with
+`python tabpy_loader.py --deploy-only`, so it is pickled by value from `__main__`
+rather than as a reference to this application, which TabPy cannot import.
+"""
+from tabpy_loader import WARM_UP, app
+
+__all__ = ["app"]
+
+WARM_UP.run()
@@ -0,0 +1,29 @@
+import os
+import subprocess
+import sys
+
+CITY_EXPLORER_FOLDER = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "city_explorer"
+)
+
+# Packages only needed to rebuild the dataset cache, never to serve requests
+REBUILD_ONLY_PACKAGES = {"sklearn", "scipy", "joblib", "openpyxl"}
+
+
+def test_serving_path_does_not_import_rebuild_packages():
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import tabpy_loader"],
+        cwd=CITY_EXPLORER_FOLDER,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # Lines look like "import time: self [us] | cumulative | imported package"
+    imported = {
+        line.rsplit("|", 1)[1].strip()
+        for line in completed.stderr.splitlines()
+        if line.startswith("import time:") and "cumulative" not in line
+    }
+    eager_imports = {name.split(".")[0] for name in imported} & REBUILD_ONLY_PACKAGES
+    assert not eager_imports, f"tabpy_loader imports {sorted(eager_imports)}"